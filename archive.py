@@ -0,0 +1,238 @@
+"""
+Archive many fanfics at once.
+
+Reads fanfic links (one per line) from files or stdin and archives the stories in a pool of processes,
+so that PDF layout runs on several cores while all processes share one polite rate limit.
+Progress is kept in a journal, so an interrupted run can be resumed, and a summary report is written at the end.
+Once a run has completed, the next one archives (or, with --update, updates) every story again.
+
+    python archive.py urls.txt --workers 4 --report report.csv
+    cat urls.txt | python archive.py --update
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional
+from cache import story_key
+from instrument import Recorder, get_recorder, set_recorder
+from fetch import FetchClient, SharedRateLimiter, set_client, DEFAULT_RATE, DEFAULT_BURST
+from generate_fanfiction_file import MAX_WORKERS
+from update import update_story
+from writers import WRITERS, generate
+
+JOURNAL_PATH = os.path.join("fanfiction", "journal.jsonl")
+REPORT_FIELDS = ['url', 'status', 'changed', 'seconds', 'fetch_seconds', 'layout_seconds', 'requests', 'retries',
+                 'bytes', 'duplicate_paragraphs', 'near_duplicate_chapters', 'error']
+PROFILE_DIR = os.path.join("fanfiction", "profiles")
+logger = logging.getLogger(__name__)
+
+
+def read_urls(sources: List[str]) -> List[str]:
+    """
+    Return the links listed in the given files ('-' for stdin), one per line, without blanks,
+    '#' comments and duplicates.
+    """
+    urls = []
+    seen = set()
+    for source in sources or ['-']:
+        lines = sys.stdin if source == '-' else open(source, encoding="utf-8")
+        with lines:
+            for line in lines:
+                url = line.split('#', 1)[0].strip()
+                if url and url not in seen:
+                    seen.add(url)
+                    urls.append(url)
+    return urls
+
+
+def load_journal(path: str) -> Dict[str, Dict]:
+    """
+    Return the last journal record of every link: {url: {'url', 'status', 'run', ...}}.
+    The status is 'pending', 'done' or 'failed'; 'run' is the id of the run that wrote the record.
+    """
+    records = {}
+    try:
+        with open(path, encoding="utf-8") as file_object:
+            for line in file_object:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # a line cut short by a crash
+                    continue
+                records[record['url']] = record
+    except OSError:
+        pass
+    return records
+
+
+def get_run_id(journal: Dict[str, Dict]) -> int:
+    """
+    Return the id of the run to journal into: the last run if it was interrupted (some of its stories are
+    still pending), so that it is resumed, and a new run otherwise.
+    """
+    last_run = max((record.get('run', 0) for record in journal.values()), default=0)
+    if any(record.get('run', 0) == last_run and record['status'] == 'pending' for record in journal.values()):
+        return last_run
+    return last_run + 1
+
+
+def append_journal(file_object, record: Dict) -> None:
+    """
+    Append a record to the journal and flush it to disk right away.
+    """
+    file_object.write(json.dumps(record) + "\n")
+    file_object.flush()
+    os.fsync(file_object.fileno())
+
+
+def init_worker(rate_limiter: SharedRateLimiter, pool_size: int) -> None:
+    """
+    Give a worker process its own pooled client, bound to the rate limit shared by all workers.
+    """
+    set_client(FetchClient(pool_size=pool_size, rate_limiter=rate_limiter))
+
+
+def archive_story(url: str, outputs: Iterable[str], update: bool, max_workers: int,
+                  profile_stage: Optional[str] = None, render_processes: int = 0, extract_processes: int = 0,
+                  collect_records: bool = False) -> Dict:
+    """
+    Archive one story in a worker process. Return its report record, with the counters and stage totals
+    collected while archiving it (and every stage record, if collect_records) under 'metrics'; never raises.
+    If profile_stage is given, that stage's cProfile stats are saved in PROFILE_DIR.
+    """
+    recorder = Recorder(profile_stage)
+    set_recorder(recorder)
+    start = time.time()
+    record = {'url': url, 'status': 'done', 'changed': True, 'error': ''}
+    try:
+        if update:
+            record['changed'] = update_story(url, outputs=outputs, max_workers=max_workers,
+                                             render_processes=render_processes, extract_processes=extract_processes)
+        else:
+            generate(url, outputs, max_workers, render_processes, extract_processes)
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    record['seconds'] = round(time.time() - start, 3)
+
+    summary = recorder.summary()
+    for stage in ('fetch', 'layout'):
+        record[stage + '_seconds'] = round(summary['stages'].get(stage, {}).get('seconds', 0.0), 3)
+    for counter in ('requests', 'retries', 'bytes', 'duplicate_paragraphs', 'near_duplicate_chapters'):
+        record[counter] = summary['counters'].get(counter, 0)
+    if profile_stage is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        key = story_key(url)
+        recorder.dump_profile(os.path.join(PROFILE_DIR, "{0}.{1}.prof".format(
+            key[0] if key else os.getpid(), profile_stage)))
+    record['metrics'] = {'records': recorder.records if collect_records else [], 'counters': recorder.counters,
+                         'stages': None if collect_records else summary['stages']}
+    return record
+
+
+def write_report(path: str, records: List[Dict]) -> None:
+    """
+    Write the per-story summary, as JSON if 'path' ends in .json and as CSV otherwise.
+    """
+    with open(path, "w", encoding="utf-8", newline="") as file_object:
+        if path.endswith(".json"):
+            json.dump([{key: record.get(key) for key in REPORT_FIELDS} for record in records], file_object, indent=2)
+        else:
+            writer = csv.DictWriter(file_object, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+
+
+def run(urls: List[str], outputs=('pdf',), update: bool = False, workers: int = os.cpu_count() or 1,
+        chapter_workers: int = MAX_WORKERS, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST,
+        journal_path: str = JOURNAL_PATH, retry_failed: bool = False,
+        profile_stage: Optional[str] = None, render_processes: int = 0, extract_processes: int = 0,
+        collect_records: bool = False) -> List[Dict]:
+    """
+    Archive every story in 'urls' with a pool of 'workers' processes. If the journal's last run was interrupted,
+    this resumes it: the stories that run already did (or failed, unless retry_failed) are skipped.
+    Return the report records of the stories processed.
+    The counters and stage totals of every story are merged into the current recorder, and its stage records
+    too if collect_records: they grow with every chapter, so they are only kept for a run report.
+    With render_processes > 1, each story's PDF is laid out by that many processes of its own,
+    and with extract_processes > 0 its chapters are parsed by that many, which suits a few long stories
+    better than many stories at once.
+    """
+    journal = load_journal(journal_path)
+    run_id = get_run_id(journal)
+    skip = ('done', 'failed') if not retry_failed else ('done',)
+    todo = [url for url in urls
+            if journal.get(url, {}).get('run', 0) != run_id or journal[url]['status'] not in skip]
+    records = []
+    if not todo:
+        return records
+
+    if os.path.dirname(journal_path):
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    rate_limiter = SharedRateLimiter(rate, burst)
+    with open(journal_path, "a", encoding="utf-8") as journal_file, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                initargs=(rate_limiter, chapter_workers)) as executor:
+        futures = {}
+        for url in todo:
+            append_journal(journal_file, {'url': url, 'status': 'pending', 'run': run_id, 'time': time.time()})
+            futures[executor.submit(archive_story, url, tuple(outputs), update, chapter_workers,
+                                     profile_stage, render_processes, extract_processes, collect_records)] = url
+        for future in as_completed(futures):
+            record = future.result()
+            metrics = record.pop('metrics')
+            get_recorder().merge(metrics['records'], metrics['counters'], metrics['stages'])
+            records.append(record)
+            append_journal(journal_file, dict(record, run=run_id, time=time.time()))
+            logger.info("[{0}] {1}{2}".format(record['status'], record['url'],
+                                              " - " + record['error'] if record['error'] else ""))
+    return records
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Archive fanfics listed in files or on stdin.")
+    parser.add_argument('sources', nargs='*', help="files with one link per line; '-' or nothing for stdin")
+    parser.add_argument('--format', dest='outputs', action='append', choices=sorted(WRITERS),
+                        help="output to generate, may be repeated (default: pdf)")
+    parser.add_argument('--update', action='store_true',
+                        help="only fetch new or changed chapters of stories archived before")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="stories processed at once")
+    parser.add_argument('--chapter-workers', type=int, default=MAX_WORKERS,
+                        help="chapters downloaded at once per story")
+    parser.add_argument('--render-processes', type=int, default=0,
+                        help="lay out each PDF's chapters in this many processes (needs pypdf)")
+    parser.add_argument('--extract-processes', type=int, default=0,
+                        help="parse each story's chapters in this many processes while it is written")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help="requests per second, all workers together")
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST, help="requests that may be sent back to back")
+    parser.add_argument('--journal', default=JOURNAL_PATH, help="the resumable job journal")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="when resuming an interrupted run, also retry the stories it failed")
+    parser.add_argument('--report', help="write a per-story summary (.csv or .json)")
+    parser.add_argument('--metrics', help="write the per-stage timings and counters of the run (.json or .csv)")
+    parser.add_argument('--profile', metavar='STAGE', choices=['fetch', 'parse', 'extract', 'layout', 'write'],
+                        help="run this stage under cProfile, saving the stats in " + PROFILE_DIR)
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every story and every failed request")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+
+    records = run(read_urls(args.sources), outputs=args.outputs or ['pdf'], update=args.update,
+                  workers=args.workers, chapter_workers=args.chapter_workers, rate=args.rate, burst=args.burst,
+                  journal_path=args.journal, retry_failed=args.retry_failed, profile_stage=args.profile,
+                  render_processes=args.render_processes, extract_processes=args.extract_processes,
+                  collect_records=bool(args.metrics))
+    if args.report:
+        write_report(args.report, records)
+    if args.metrics:
+        get_recorder().write(args.metrics)
+    failed = sum(1 for record in records if record['status'] == 'failed')
+    print("{0} stories processed, {1} failed".format(len(records), failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""
+Offline benchmark of the scraper against a local stand-in for fanfiction.net.
+
+A local HTTP server serves synthetic story pages (#profile_top, #chap_select, #storytext) with a
+configurable number of chapters, paragraphs per chapter and HTML nesting depth, and can inject
+latency and 503 errors. The benchmark times each stage (fetch, parse, markup translation, PDF layout)
+on its own, then runs generate_pdf and generate_text_file end to end in a fresh process each,
+reporting their wall time, the number of requests they made and their peak RSS.
+
+    python benchmark.py --chapters 30 --paragraphs 80 --depth 3 --latency 0.02 --json bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate
+import generate_fanfiction_file as fanfic
+from cache import set_cache, STORY_LINK
+from fetch import FetchClient, RateLimiter, set_client
+from instrument import get_recorder
+
+WORDS = ("the quick brown fox jumps over a lazy dog while sakura watches naruto train under "
+         "falling leaves and the village hums with quiet anticipation of tomorrow").split()
+# Inline and block wrappers used to nest the synthetic paragraphs, as authors' HTML does
+WRAPPERS = [('<div>', '</div>'), ('<center>', '</center>'), ('<strong>', '</strong>'), ('<em>', '</em>'),
+            ('<span style="text-decoration:underline;">', '</span>')]
+
+
+def make_paragraph(rng: random.Random, depth: int) -> str:
+    """
+    Return one synthetic paragraph, wrapped in up to 'depth' levels of formatting and containers.
+    """
+    words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+    for i in range(0, len(words), 9):
+        words[i] = rng.choice(['<em>{}</em>', '<strong>{}</strong>', '{}&amp;', '{}']).format(words[i])
+    html = '<p>' + ' '.join(words) + '</p>'
+    for _ in range(rng.randint(0, depth)):
+        opening, closing = rng.choice(WRAPPERS)
+        html = opening + html + closing
+    return html
+
+
+def make_page(story_id: int, chapter: int, chapters: int, paragraphs: int, depth: int) -> bytes:
+    """
+    Return the HTML of a synthetic chapter page, laid out like fanfiction.net's.
+    """
+    rng = random.Random(story_id * 100003 + chapter)
+    options = ''.join('<option  value={0} {1}>{0}. Chapter {0}'.format(n, 'selected' if n == chapter else '')
+                      for n in range(1, chapters + 1))
+    select = '<select id=chap_select title="Chapter Navigation" Name=chapter>{}</select>'.format(options)
+    text = '\n'.join(make_paragraph(rng, depth) for _ in range(paragraphs))
+    page = """<html><head><meta charset="utf-8"><title>Benchmark {story_id}</title></head><body>
+<div id=pre_story_links><span class=lc-left><a href='/anime/'>Anime</a><a class=xcontrast_txt href="/anime/Bench/">Bench</a></span></div>
+<div id=profile_top><b class='xcontrast_txt'>Benchmark Story {story_id}</b>
+<span class='xcontrast_txt'>By:</span> <a class='xcontrast_txt' href='/u/1/Bench-Author'>Bench Author</a>
+<div class='xcontrast_txt'>A synthetic story used to benchmark the scraper.</div>
+<span class='xgray xcontrast_txt'>Rated: <a class='xcontrast_txt' href='https://www.fictionratings.com/'>Fiction  T</a> - English - Adventure/Drama - Naruto U., Sakura H. - Chapters: {chapters} - Words: {words:,} - Reviews: <a href='/r/{story_id}/'>10</a> - Favs: 20 - Follows: 30 - Updated: <span data-xutime='1400000000'>5/13/2014</span> - Published: <span data-xutime='1300000000'>3/13/2011</span> - id: {story_id} </span>
+</div>
+{select}
+<div id='storytextp'><div class='storytext xcontrast_txt nocopy' id='storytext'>
+{text}
+</div></div>
+{select}
+<div id=reviews>{ads}</div>
+</body></html>""".format(story_id=story_id, chapters=chapters, words=chapters * paragraphs * 50, select=select,
+                         text=text, ads='<div class=ad><script>var x=1;</script></div>' * 50)
+    return page.encode('utf-8')
+
+
+class StandInServer:
+    """
+    A local stand-in for fanfiction.net, serving synthetic stories from a background thread.
+    """
+
+    def __init__(self, chapters: int, paragraphs: int, depth: int, latency: float = 0.0, error_rate: float = 0.0):
+        self.chapters = chapters
+        self.paragraphs = paragraphs
+        self.depth = depth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.pages = {}  # type: Dict[tuple, bytes]
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with stand_in.lock:
+                    stand_in.requests += 1
+                time.sleep(stand_in.latency)
+                match = STORY_LINK.search(self.path)
+                if match is None or random.random() < stand_in.error_rate:
+                    self.send_response(404 if match is None else 503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = stand_in.page(int(match.group(1)), int(match.group(2)))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def page(self, story_id: int, chapter: int) -> bytes:
+        key = (story_id, chapter)
+        if key not in self.pages:
+            self.pages[key] = make_page(story_id, chapter, self.chapters, self.paragraphs, self.depth)
+        return self.pages[key]
+
+    def url(self, story_id: int = 1, chapter: int = 1) -> str:
+        host, port = self.server.server_address
+        return 'http://{0}:{1}/s/{2}/{3}/Benchmark-Story'.format(host, port, story_id, chapter)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def setup_process(rate: float) -> None:
+    """
+    Point the scraper at the stand-in server: no proxy, no cache, and the given rate limit.
+    """
+    set_client(FetchClient(proxies={}, backoff_factor=0.05, rate_limiter=RateLimiter(rate, max(1, int(rate)))))
+    set_cache(None)
+
+
+def reset_peak_rss() -> None:
+    """
+    Reset this process's peak RSS to its current RSS (Linux only). A spawned process otherwise starts out with
+    its parent's peak, since ru_maxrss survives the fork and exec.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file_object:
+            file_object.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Return this process's peak RSS in MB since reset_peak_rss(), or since it started where that isn't supported.
+    """
+    try:
+        with open('/proc/self/status') as file_object:
+            for line in file_object:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_end_to_end(kind: str, url: str, rate: float, workdir: str) -> Dict:
+    """
+    Run generate_pdf or generate_text_file in this (fresh) process.
+    Return its wall time, peak RSS and the recorder's per-stage report.
+    """
+    reset_peak_rss()
+    os.chdir(workdir)
+    setup_process(rate)
+    start = time.perf_counter()
+    if kind == 'pdf':
+        fanfic.generate_pdf(url)
+    else:
+        fanfic.generate_text_file(url)
+    return {'seconds': time.perf_counter() - start,
+            'peak_rss_mb': get_peak_rss_mb(),
+            'report': get_recorder().summary()}
+
+
+def benchmark(chapters: int = 20, paragraphs: int = 50, depth: int = 2, latency: float = 0.0,
+              error_rate: float = 0.0, rate: float = 1000.0) -> Dict:
+    """
+    Benchmark every stage against a stand-in server and return the results.
+    """
+    results = {'config': {'chapters': chapters, 'paragraphs': paragraphs, 'depth': depth,
+                          'latency': latency, 'error_rate': error_rate, 'rate': rate}}
+    with tempfile.TemporaryDirectory(prefix='fanfic-bench-') as workdir, \
+            StandInServer(chapters, paragraphs, depth, latency, error_rate) as server:
+        os.makedirs(os.path.join(workdir, 'fanfiction'))
+        setup_process(rate)
+        links = fanfic.StoryPage(server.url()).generate_links()
+        server.requests = 0
+
+        start = time.perf_counter()
+        pages = fanfic.map_chapters(fanfic.simple_get, links)
+        results['fetch_seconds'] = time.perf_counter() - start
+        results['fetch_requests'] = server.requests
+        results['fetch_bytes'] = sum(len(page) for page in pages)
+
+        start = time.perf_counter()
+        soups = [fanfic.parse_page(page) for page in pages]
+        results['parse_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chapter_texts = [list(fanfic.iter_text(soup.find("div", attrs={"id": "storytext"}))) for soup in soups]
+        results['translate_seconds'] = time.perf_counter() - start
+        results['paragraphs'] = sum(len(text) for text in chapter_texts)
+        del soups, pages
+
+        fanfic.register_fonts(fanfic.FONT_FILES)
+        flowables = [fanfic.make_paragraph(paragraph, fanfic.style) for text in chapter_texts for paragraph in text]
+        doc = SimpleDocTemplate(os.path.join(workdir, 'layout.pdf'), pagesize=letter)
+        start = time.perf_counter()
+        doc.build(flowables)
+        results['layout_seconds'] = time.perf_counter() - start
+
+        for kind in ('pdf', 'txt'):
+            server.requests = 0
+            # A fresh interpreter per run, so that peak RSS only counts that run
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_end_to_end, kind, server.url(), rate, workdir).result()
+            result['requests_per_story'] = server.requests
+            results['generate_' + kind] = result
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against a local stand-in server.")
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--paragraphs', type=int, default=50, help="paragraphs per chapter")
+    parser.add_argument('--depth', type=int, default=2, help="maximum nesting of wrappers around a paragraph")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of responses that are 503s")
+    parser.add_argument('--rate', type=float, default=1000.0, help="client rate limit, requests per second")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.chapters, args.paragraphs, args.depth, args.latency, args.error_rate, args.rate)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file_object:
+            json.dump(results, file_object, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
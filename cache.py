@@ -0,0 +1,265 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+# Cached chapters live next to the generated files, in fanfiction/.cache/<story id>/<chapter>.html.gz
+CACHE_DIR = os.path.join("fanfiction", ".cache")
+DEFAULT_TTL = 24 * 60 * 60  # one day, in seconds
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Matches the story id and chapter number in links such as https://www.fanfiction.net/s/8099181/2/Avatar-of-Victory
+STORY_LINK = re.compile(r'/s/(\d+)/(\d+)')
+
+
+def story_key(url: str) -> Optional[Tuple[str, int]]:
+    """
+    Return the (story id, chapter number) of a fanfic link, or None if the link is not a fanfic chapter.
+    """
+    match = STORY_LINK.search(url)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+class CacheEntry:
+    """
+    A cached chapter: its raw HTML, the response headers it was served with, and when it was fetched.
+    """
+
+    def __init__(self, content: bytes, headers: Dict, fetched_at: float, sha256: str):
+        self.content = content
+        self.headers = headers
+        self.fetched_at = fetched_at
+        self.sha256 = sha256
+
+    def age(self) -> float:
+        """
+        Return how long ago (in seconds) the chapter was fetched or last revalidated.
+        """
+        return time.time() - self.fetched_at
+
+
+class ChapterCache:
+    """
+    An on-disk cache of the raw HTML of fanfic chapters, keyed by story id and chapter number.
+
+    Each chapter is stored gzip-compressed, with a JSON sidecar holding the response headers,
+    the fetch time and the SHA-256 of the content. Entries older than 'ttl' are revalidated
+    with a conditional request; the least recently used entries are evicted once the cache
+    grows past 'max_bytes'. In offline mode, chapters are only ever served from the cache.
+    """
+
+    def __init__(self, root: str = CACHE_DIR, ttl: Optional[float] = DEFAULT_TTL,
+                 max_bytes: int = DEFAULT_MAX_BYTES, offline: bool = False):
+        """
+        :param root: The cache folder.
+        :param ttl: How long (in seconds) a chapter is served without revalidation; None to never revalidate.
+        :param max_bytes: The size the cache folder is kept under.
+        :param offline: Never touch the network; chapters missing from the cache are errors.
+        """
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.size = None  # type: Optional[int]
+
+    def paths(self, url: str) -> Optional[Tuple[str, str]]:
+        """
+        Return the paths of the compressed HTML and of the metadata of a chapter, or None if 'url' isn't cacheable.
+        """
+        key = story_key(url)
+        if key is None:
+            return None
+        base = os.path.join(self.root, key[0], str(key[1]))
+        return base + ".html.gz", base + ".json"
+
+    def load(self, url: str) -> Optional[CacheEntry]:
+        """
+        Return the cached entry of a chapter, or None on a cache miss.
+        Loading an entry marks it as recently used.
+        """
+        paths = self.paths(url)
+        if paths is None:
+            return None
+        html_path, meta_path = paths
+        try:
+            with open(meta_path, encoding="utf-8") as file_object:
+                meta = json.load(file_object)
+            with gzip.open(html_path, "rb") as file_object:
+                content = file_object.read()
+        except (OSError, ValueError, EOFError):
+            return None
+        os.utime(meta_path)  # the metadata's mtime is the entry's last use, for LRU eviction
+        return CacheEntry(content, meta["headers"], meta["fetched_at"], meta["sha256"])
+
+    def fetched_at(self, url: str) -> Optional[float]:
+        """
+        Return when a chapter was fetched or last revalidated, or None if it isn't cached.
+        Only its metadata is read, and it isn't marked as recently used.
+        """
+        paths = self.paths(url)
+        if paths is None:
+            return None
+        try:
+            with open(paths[1], encoding="utf-8") as file_object:
+                return json.load(file_object)["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        """
+        Return True if 'entry' can be served without asking the server whether it changed.
+        """
+        return self.ttl is None or entry.age() < self.ttl
+
+    def store(self, url: str, content: bytes, headers: Dict) -> Optional[CacheEntry]:
+        """
+        Cache the raw HTML of a chapter along with its response headers. Return the new entry.
+        """
+        paths = self.paths(url)
+        if paths is None:
+            return None
+        html_path, meta_path = paths
+        entry = CacheEntry(content, dict(headers), time.time(), hashlib.sha256(content).hexdigest())
+        old_size = entry_size(paths)
+        os.makedirs(os.path.dirname(html_path), exist_ok=True)
+        write_atomic(html_path, gzip.compress(content))
+        write_meta(meta_path, entry)
+        self.grow(entry_size(paths) - old_size)
+        return entry
+
+    def revalidated(self, url: str, entry: CacheEntry) -> CacheEntry:
+        """
+        Record that the server confirmed (304 Not Modified) that a cached chapter is still current.
+        """
+        paths = self.paths(url)
+        entry.fetched_at = time.time()
+        if paths is not None:
+            write_meta(paths[1], entry)
+        return entry
+
+    def grow(self, delta: int) -> None:
+        """
+        Account for 'delta' bytes added to the cache, evicting the least recently used entries if it's too big.
+        """
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.entries())
+            else:
+                self.size += delta
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        """
+        Yield (metadata path, size in bytes, last use) for every entry in the cache.
+        """
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    meta_path = os.path.join(dirpath, filename)
+                    html_path = meta_path[:-len(".json")] + ".html.gz"
+                    try:
+                        last_used = os.path.getmtime(meta_path)
+                    except OSError:
+                        continue
+                    yield meta_path, entry_size((html_path, meta_path)), last_used
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used entries until the cache is under max_bytes. Call with the lock held.
+        """
+        for meta_path, size, _ in sorted(self.entries(), key=lambda e: e[2]):
+            if self.size <= self.max_bytes:
+                break
+            for path in (meta_path[:-len(".json")] + ".html.gz", meta_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.size -= size
+
+
+def conditional_headers(entry: CacheEntry) -> Dict:
+    """
+    Return the headers asking the server to answer 304 Not Modified if a cached chapter didn't change.
+    """
+    headers = {}
+    for header, conditional in (("ETag", "If-None-Match"), ("Last-Modified", "If-Modified-Since")):
+        for key, value in entry.headers.items():
+            if key.lower() == header.lower():
+                headers[conditional] = value
+    return headers
+
+
+def entry_size(paths: Tuple[str, str]) -> int:
+    """
+    Return the number of bytes an entry takes on disk (0 if it doesn't exist).
+    """
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+@contextmanager
+def atomic_path(path: str) -> Iterator[str]:
+    """
+    Yield a temporary path next to 'path' to write a file to. Once the with block succeeds, the file
+    replaces 'path' in one step; if it fails, the file is removed. Either way 'path' is never half-written.
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """
+    Write 'data' to 'path' through a temporary file, so that a crash never leaves a half-written file.
+    """
+    with atomic_path(path) as tmp_path, open(tmp_path, "wb") as file_object:
+        file_object.write(data)
+
+
+def write_meta(meta_path: str, entry: CacheEntry) -> None:
+    """
+    Write the metadata of a cache entry.
+    """
+    meta = {"headers": entry.headers, "fetched_at": entry.fetched_at, "sha256": entry.sha256}
+    write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+
+_UNSET = object()
+_cache = _UNSET
+
+
+def get_cache() -> Optional[ChapterCache]:
+    """
+    Return the cache used by simple_get, creating it with the default settings on first use.
+    None means caching is disabled.
+    """
+    global _cache
+    if _cache is _UNSET:
+        _cache = ChapterCache()
+    return _cache
+
+
+def set_cache(cache: Optional[ChapterCache]) -> None:
+    """
+    Replace the cache used by simple_get, e.g. to change its TTL or size or to go offline; None disables caching.
+    """
+    global _cache
+    _cache = cache
@@ -0,0 +1,232 @@
+"""
+A local SQLite catalog of every archived fanfic, for querying the archive without rescanning files
+or refetching pages: profile fields, chapters (with content hashes and word counts), output files and fetch times.
+
+    python catalog.py --fandom Naruto --status In-Progress --since 2024-01-01
+    python catalog.py --search "time travel"
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from generate_fanfiction_file import Fanfic, markup_to_text
+from cache import get_cache
+
+CATALOG_PATH = os.path.join("fanfiction", "catalog.sqlite")
+# Profile keys stored as columns of the stories table, and those of them that are counts
+PROFILE_COLUMNS = ['title', 'author', 'author_link', 'fandom', 'rating', 'language', 'genre', 'characters',
+                   'chapters', 'words', 'reviews', 'favs', 'follows', 'status', 'publication_date', 'updated_date',
+                   'summary']
+COUNT_COLUMNS = frozenset(['chapters', 'words', 'reviews', 'favs', 'follows'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    story_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    title TEXT, author TEXT, author_link TEXT, fandom TEXT, rating TEXT, language TEXT, genre TEXT,
+    characters TEXT, chapters INTEGER, words INTEGER, reviews INTEGER, favs INTEGER, follows INTEGER,
+    status TEXT, publication_date TEXT, updated_date TEXT, summary TEXT,
+    published_at REAL, updated_at REAL, fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stories_fandom ON stories (fandom);
+CREATE INDEX IF NOT EXISTS stories_author ON stories (author);
+CREATE INDEX IF NOT EXISTS stories_status ON stories (status);
+CREATE INDEX IF NOT EXISTS stories_updated ON stories (updated_at);
+CREATE TABLE IF NOT EXISTS chapters (
+    story_id TEXT NOT NULL REFERENCES stories (story_id) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    name TEXT, link TEXT, sha256 TEXT, words INTEGER, fetched_at REAL,
+    PRIMARY KEY (story_id, number)
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    story_id TEXT NOT NULL REFERENCES stories (story_id) ON DELETE CASCADE,
+    format TEXT NOT NULL,
+    path TEXT NOT NULL,
+    written_at REAL NOT NULL,
+    PRIMARY KEY (story_id, format)
+);
+"""
+FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5 (story_id UNINDEXED, title, summary)"
+
+
+def parse_count(text: str) -> Optional[int]:
+    """
+    Return a profile count ('12,345') as an int.
+    """
+    try:
+        return int(text.replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+
+class Catalog:
+    """
+    The SQLite catalog of the archive. Stories are upserted by story id every time they are archived.
+    """
+
+    def __init__(self, path: str = CATALOG_PATH):
+        """
+        :param path: The SQLite database file; created if it doesn't exist.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # Pool workers share the file, so wait on their locks instead of failing
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute("PRAGMA foreign_keys = ON")
+            self.db.executescript(SCHEMA)
+            try:
+                self.db.execute(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:  # SQLite built without FTS5: search falls back to LIKE
+                self.fts = False
+
+    def add_story(self, fanfic: Fanfic, paths: Iterable[str] = ()) -> None:
+        """
+        Record a fanfic: its profile, every chapter it has downloaded and the files written from it.
+        :param fanfic: The fanfic.
+        :param paths: The output files written from it.
+        """
+        profile = fanfic.profile
+        story_id = profile.get('story_id') or fanfic.url
+        now = time.time()
+        cache = get_cache()
+
+        def fetched_at(link: str) -> float:
+            # When the page was actually downloaded, which is now only if it wasn't cached
+            value = cache.fetched_at(link) if cache is not None else None
+            return now if value is None else value
+
+        values = {column: parse_count(profile.get(column)) if column in COUNT_COLUMNS else profile.get(column)
+                  for column in PROFILE_COLUMNS}
+        values.update(story_id=story_id, url=fanfic.url, fetched_at=fetched_at(fanfic.url),
+                      published_at=profile.get('published_at'),
+                      # A story never updated since it was published only shows its publication date
+                      updated_at=profile.get('updated_at') or profile.get('published_at'))
+        chapters = []
+        for chapter in fanfic.chapters:
+            text = "\n".join(markup_to_text(paragraph) for paragraph in chapter.paragraphs)
+            chapters.append((story_id, chapter.number, chapter.name, chapter.link,
+                             hashlib.sha256(text.encode('utf-8')).hexdigest(), len(text.split()),
+                             fetched_at(chapter.link)))
+
+        # Upserts rather than INSERT OR REPLACE: replacing a story's row would delete it first, and with it
+        # (ON DELETE CASCADE) the outputs written by earlier runs in other formats
+        columns = ', '.join(values)
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO stories ({0}) VALUES ({1}) ON CONFLICT (story_id) DO UPDATE SET {2}".format(
+                columns, ', '.join(':' + column for column in values),
+                ', '.join('{0} = excluded.{0}'.format(column) for column in values if column != 'story_id')), values)
+            self.db.executemany("INSERT INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (story_id, number) "
+                                "DO UPDATE SET name = excluded.name, link = excluded.link, sha256 = excluded.sha256, "
+                                "words = excluded.words, fetched_at = excluded.fetched_at", chapters)
+            # Chapters the author has since deleted
+            self.db.execute("DELETE FROM chapters WHERE story_id = ? AND number > ?",
+                            (story_id, len(fanfic.chap_links)))
+            self.db.executemany("INSERT INTO outputs VALUES (?, ?, ?, ?) ON CONFLICT (story_id, format) "
+                                "DO UPDATE SET path = excluded.path, written_at = excluded.written_at",
+                                [(story_id, os.path.splitext(path)[1].lstrip('.'), path, now) for path in paths])
+            if self.fts:
+                self.db.execute("DELETE FROM stories_fts WHERE story_id = ?", (story_id,))
+                self.db.execute("INSERT INTO stories_fts (story_id, title, summary) VALUES (?, ?, ?)",
+                                (story_id, profile.get('title'), profile.get('summary')))
+
+    def query(self, fandom: Optional[str] = None, author: Optional[str] = None, status: Optional[str] = None,
+              updated_since: Optional[float] = None, search: Optional[str] = None, limit: int = 1000) -> List[Dict]:
+        """
+        Return the stories matching all the given filters, most recently updated first.
+        :param fandom: The exact fandom.
+        :param author: The exact author name.
+        :param status: 'Complete' or 'In-Progress'.
+        :param updated_since: A timestamp; only stories updated since then.
+        :param search: Full-text search over titles and summaries (FTS5 query syntax).
+        :param limit: The maximum number of stories returned.
+        """
+        where, params = [], []
+        for column, value in (('fandom', fandom), ('author', author), ('status', status)):
+            if value is not None:
+                where.append("s.{} = ?".format(column))
+                params.append(value)
+        if updated_since is not None:
+            where.append("s.updated_at >= ?")
+            params.append(updated_since)
+        if search is not None:
+            if self.fts:
+                where.append("s.story_id IN (SELECT story_id FROM stories_fts WHERE stories_fts MATCH ?)")
+                params.append(search)
+            else:
+                where.append("(s.summary LIKE ? OR s.title LIKE ?)")
+                params.extend(['%' + search + '%'] * 2)
+        sql = "SELECT s.* FROM stories s"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY s.updated_at DESC, s.published_at DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    def get_chapters(self, story_id: str) -> List[Dict]:
+        """
+        Return the catalogued chapters of a story, in order.
+        """
+        with self.lock:
+            return [dict(row) for row in self.db.execute(
+                "SELECT * FROM chapters WHERE story_id = ? ORDER BY number", (story_id,))]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+_UNSET = object()
+_catalog = _UNSET
+
+
+def get_catalog() -> Optional[Catalog]:
+    """
+    Return the catalog archived stories are recorded in, opening the default one on first use.
+    None means cataloguing is disabled.
+    """
+    global _catalog
+    if _catalog is _UNSET:
+        _catalog = Catalog()
+    return _catalog
+
+
+def set_catalog(catalog: Optional[Catalog]) -> None:
+    """
+    Replace the catalog archived stories are recorded in; None disables cataloguing.
+    """
+    global _catalog
+    _catalog = catalog
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Query the catalog of archived fanfics.")
+    parser.add_argument('--catalog', default=CATALOG_PATH)
+    parser.add_argument('--fandom')
+    parser.add_argument('--author')
+    parser.add_argument('--status', choices=['Complete', 'In-Progress'])
+    parser.add_argument('--since', help="only stories updated on or after this date (YYYY-MM-DD)")
+    parser.add_argument('--search', help="full-text search over titles and summaries")
+    parser.add_argument('--limit', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    since = datetime.strptime(args.since, '%Y-%m-%d').timestamp() if args.since else None
+    catalog = Catalog(args.catalog)
+    for story in catalog.query(args.fandom, args.author, args.status, since, args.search, args.limit):
+        print(json.dumps(story))
+    catalog.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
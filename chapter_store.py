@@ -0,0 +1,107 @@
+import mmap
+import struct
+from array import array
+from typing import Iterable, Iterator, Optional
+
+# The file layout of a stored chapter: the number of paragraphs (uint32), the paragraph offsets (uint32 each,
+# one more than the paragraphs) and the UTF-8 text of all paragraphs back to back. The integers are in
+# the machine's byte order, as the files are checkpoints read back by the machine that wrote them.
+COUNT = struct.Struct('=I')
+OFFSET_TYPE = 'I'
+
+
+class ChapterText:
+    """
+    The paragraphs of a chapter (ReportLab paragraph markup), stored compactly: one contiguous UTF-8 buffer
+    and an array of offsets into it, instead of a list of str objects. Paragraphs are decoded one at a time
+    as they are iterated over, so writers only ever hold the paragraphs they are working on.
+
+    The buffer is either in memory or in a file (see open()), which is memory-mapped only while
+    the paragraphs are being read. A ChapterText otherwise behaves like a read-only list of str.
+    """
+
+    def __init__(self, offsets: array, data: Optional[bytes] = None, path: Optional[str] = None):
+        """
+        :param offsets: The start of every paragraph in the UTF-8 text, then its end.
+        :param data: The UTF-8 text, if it is held in memory.
+        :param path: The chapter file holding the UTF-8 text otherwise.
+        """
+        self.offsets = offsets
+        self.data = data
+        self.path = path
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs: Iterable[str]) -> 'ChapterText':
+        """
+        Return the paragraphs stored in memory.
+        """
+        offsets = array(OFFSET_TYPE, [0])
+        chunks = []
+        end = 0
+        for paragraph in paragraphs:
+            chunk = paragraph.encode('utf-8')
+            chunks.append(chunk)
+            end += len(chunk)
+            offsets.append(end)
+        return cls(offsets, data=b''.join(chunks))
+
+    @classmethod
+    def open(cls, path: str) -> 'ChapterText':
+        """
+        Return the chapter stored in a file written from to_bytes(). Only the offsets are read now.
+        """
+        with open(path, 'rb') as file_object:
+            count, = COUNT.unpack(file_object.read(COUNT.size))
+            offsets = array(OFFSET_TYPE)
+            offsets.fromfile(file_object, count + 1)
+        return cls(offsets, path=path)
+
+    def to_bytes(self) -> bytes:
+        """
+        Return the chapter in its file layout.
+        """
+        data = self.data
+        if data is None:
+            with open(self.path, 'rb') as file_object:
+                file_object.seek(self.data_start())
+                data = file_object.read()
+        return COUNT.pack(len(self)) + self.offsets.tobytes() + data
+
+    def data_start(self) -> int:
+        """
+        Return where the UTF-8 text starts in the chapter's file.
+        """
+        return COUNT.size + self.offsets.itemsize * len(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        offsets = self.offsets
+        if self.data is not None:
+            for i in range(len(self)):
+                yield self.data[offsets[i]:offsets[i + 1]].decode('utf-8')
+            return
+        start = self.data_start()
+        with open(self.path, 'rb') as file_object, \
+                mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for i in range(len(self)):
+                yield mapped[start + offsets[i]:start + offsets[i + 1]].decode('utf-8')
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('paragraph index out of range')
+        begin, end = self.offsets[index], self.offsets[index + 1]
+        if self.data is not None:
+            return self.data[begin:end].decode('utf-8')
+        with open(self.path, 'rb') as file_object:
+            file_object.seek(self.data_start() + begin)
+            return file_object.read(end - begin).decode('utf-8')
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other) if isinstance(other, (ChapterText, list)) else NotImplemented
+
+    def __repr__(self) -> str:
+        return 'ChapterText({} paragraphs{})'.format(len(self), ', ' + repr(self.path) if self.path else '')
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+from typing import Dict, List
+from cache import write_atomic
+from chapter_store import ChapterText
+
+# Chapters extracted by a build that hasn't finished yet: fanfiction/.checkpoints/<story id>/<chapter>.chapter
+CHECKPOINT_DIR = os.path.join("fanfiction", ".checkpoints")
+# The profile fields that identify a version of a story: they change whenever the author posts or edits a chapter,
+# or marks the story complete. Also what update.py compares to decide whether a story needs regenerating.
+VERSION_KEYS = ('chapters', 'words', 'updated_date', 'status')
+
+
+class Checkpoints:
+    """
+    The chapters of a story saved one by one as a build extracts them, so that a build that fails part way
+    (e.g. on a flaky proxy) resumes where it stopped instead of downloading and parsing every chapter again.
+
+    Chapters are saved in the ChapterText file layout, and read back from the files on demand,
+    so a big story's text doesn't have to be held in memory while it is built.
+
+    The checkpoints belong to one version of the story: if it was updated since they were saved
+    (new chapters, new words, renamed chapters, a new status), they are discarded.
+    """
+
+    def __init__(self, story_id: str, profile_dict: Dict, lst_chap_names: List, root: str = CHECKPOINT_DIR):
+        """
+        :param story_id: The id of the story.
+        :param profile_dict: The current profile of the story.
+        :param lst_chap_names: The current chapter names.
+        :param root: The directory checkpoints are kept in, one directory per story.
+        """
+        self.dir = os.path.join(root, story_id)
+        self.version = {key: profile_dict.get(key) for key in VERSION_KEYS}
+        self.version['chap_names'] = lst_chap_names
+        manifest_path = os.path.join(self.dir, "manifest.json")
+        try:
+            with open(manifest_path, encoding="utf-8") as file_object:
+                manifest = json.load(file_object)
+        except (OSError, ValueError):
+            manifest = None
+        if manifest != self.version:
+            self.clear()
+            os.makedirs(self.dir, exist_ok=True)
+            write_atomic(manifest_path, json.dumps(self.version).encode("utf-8"))
+
+    def get_path(self, number: int) -> str:
+        return os.path.join(self.dir, "{}.chapter".format(number))
+
+    def load(self) -> Dict[int, ChapterText]:
+        """
+        Return every chapter saved so far, by chapter number.
+        """
+        chapters = {}
+        try:
+            names = os.listdir(self.dir)
+        except OSError:
+            return chapters
+        for name in names:
+            number, extension = os.path.splitext(name)
+            if extension != ".chapter" or not number.isdigit():
+                continue
+            try:
+                chapters[int(number)] = ChapterText.open(os.path.join(self.dir, name))
+            except (OSError, EOFError, ValueError):
+                continue
+        return chapters
+
+    def save(self, number: int, text: ChapterText) -> ChapterText:
+        """
+        Save a chapter, and return it read from its checkpoint file instead of memory.
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        path = self.get_path(number)
+        write_atomic(path, text.to_bytes())
+        return ChapterText.open(path)
+
+    def clear(self) -> None:
+        """
+        Delete the story's checkpoints, once its build is complete. Chapters read from them can't be read after this.
+        """
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,103 @@
+"""
+Repeated text in fanfics: paragraphs an author's HTML repeats within a chapter, and chapters that are
+(nearly) the same as another chapter of the story, e.g. a chapter reposted under a new name.
+"""
+import re
+from html import unescape
+from typing import Dict, Iterable, List, Set, Tuple
+
+# Exact repeats shorter than this (scene breaks, '...', a one-line refrain) are kept, being most likely deliberate
+MIN_DUPLICATE_CHARS = 80
+# Chapters are compared on runs of this many words, keeping one in SHINGLE_SAMPLE of them
+SHINGLE_WORDS = 5
+SHINGLE_SAMPLE = 4
+# The share of sampled runs two chapters must have in common to be reported
+NEAR_DUPLICATE_SIMILARITY = 0.8
+TAGS = re.compile(r'<[^>]*>')
+SPACES = re.compile(r'\s+')
+
+
+def normalize(paragraph: str) -> str:
+    """
+    Return the text of a paragraph of ReportLab markup, for comparison: no tags, entities decoded,
+    whitespace collapsed and case folded.
+    """
+    return SPACES.sub(' ', unescape(TAGS.sub(' ', paragraph))).strip().casefold()
+
+
+def is_concatenation(text: str, texts: List[str], start: int, step: int) -> bool:
+    """
+    Return True if 'text' is exactly two or more consecutive entries of 'texts' joined by spaces, starting at
+    index 'start' and going forwards (step 1) or backwards (step -1, the entries then ending the text).
+    """
+    count = 0
+    i = start
+    while text and 0 <= i < len(texts) and texts[i]:
+        piece = texts[i]
+        if step > 0 and text.startswith(piece):
+            text = text[len(piece):].lstrip()
+        elif step < 0 and text.endswith(piece):
+            text = text[:-len(piece)].rstrip()
+        else:
+            return False
+        count += 1
+        i += step
+    return not text and count >= 2
+
+
+def dedupe_paragraphs(paragraphs: List[str]) -> Tuple[List[str], int]:
+    """
+    Return the paragraphs of a chapter without the repeated ones, and how many were dropped.
+
+    A paragraph is dropped if it repeats an earlier paragraph of at least MIN_DUPLICATE_CHARS characters,
+    or if it is nothing but the paragraphs right before or after it run together (a container that was
+    extracted whole as well as paragraph by paragraph); the separate paragraphs are kept then.
+    :param paragraphs: The paragraphs (ReportLab markup), in order.
+    """
+    texts = [normalize(paragraph) for paragraph in paragraphs]
+    seen = set()  # type: Set[str]
+    kept = []
+    for i, (paragraph, text) in enumerate(zip(paragraphs, texts)):
+        if len(text) >= MIN_DUPLICATE_CHARS:
+            if text in seen or is_concatenation(text, texts, i + 1, 1) or is_concatenation(text, texts, i - 1, -1):
+                continue
+            seen.add(text)
+        kept.append(paragraph)
+    return kept, len(paragraphs) - len(kept)
+
+
+def shingles(paragraphs: Iterable[str]) -> Set[int]:
+    """
+    Return the sampled hashes of every run of SHINGLE_WORDS words of a chapter. Sampling by hash value
+    (rather than by position) keeps the same runs in two chapters even if one has extra text.
+    """
+    words = ' '.join(normalize(paragraph) for paragraph in paragraphs).split()
+    if not words:
+        return set()
+    hashes = (hash(tuple(words[i:i + SHINGLE_WORDS])) for i in range(max(1, len(words) - SHINGLE_WORDS + 1)))
+    return {value for value in hashes if value % SHINGLE_SAMPLE == 0}
+
+
+def near_duplicate_chapters(chapters: List,
+                            threshold: float = NEAR_DUPLICATE_SIMILARITY) -> List[Tuple[int, int, float]]:
+    """
+    Return the pairs of chapters with (nearly) the same text: [(chapter number, later chapter number, similarity)],
+    the similarity being the Jaccard index of their sampled shingles, from 0 to 1.
+    Only chapters sharing at least one shingle are compared.
+    :param chapters: The Chapter objects of a story.
+    :param threshold: The lowest similarity reported.
+    """
+    sets = {chapter.number: shingles(chapter.paragraphs) for chapter in chapters}
+    index = {}  # type: Dict[int, List[int]]
+    shared = {}  # type: Dict[Tuple[int, int], int]
+    for number, values in sets.items():
+        for value in values:
+            for other in index.setdefault(value, []):
+                shared[other, number] = shared.get((other, number), 0) + 1
+            index[value].append(number)
+    pairs = []
+    for (first, second), common in sorted(shared.items()):
+        similarity = common / (len(sets[first]) + len(sets[second]) - common)
+        if similarity >= threshold:
+            pairs.append((first, second, round(similarity, 3)))
+    return pairs
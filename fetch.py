@@ -0,0 +1,230 @@
+import multiprocessing
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+# Session().proxies['http'] = 'socks5://localhost:9150'  # 9150 for browser; 9050 for TOR service
+DEFAULT_PROXIES = {'https': 'socks5://localhost:9150'}
+DEFAULT_HEADERS = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+                                 ' (KHTML, like Gecko) Chrome/89.0.4389.90 Safari/537.36'}
+# Status codes worth trying again: rate limiting and transient server errors
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Politeness defaults: requests per second to a single host, and how many may be sent back to back
+DEFAULT_RATE = 4.0
+DEFAULT_BURST = 8
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket: tokens are added at a steady 'rate' per second, up to 'burst' tokens,
+    and every request spends one token, waiting for it if the bucket is empty.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Take one token, blocking until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    Keeps one TokenBucket per host, so that every host is rate limited independently.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # type: Dict[str, TokenBucket]
+        self.lock = threading.Lock()
+
+    def acquire(self, url: str) -> None:
+        """
+        Wait until a request to the host of 'url' is allowed.
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+        bucket.acquire()
+
+
+class SharedRateLimiter:
+    """
+    A single token bucket kept in shared memory, so that the processes of a pool share one rate limit.
+    Create it in the parent process and hand it to the workers (e.g. through the pool's initializer).
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.lock = multiprocessing.Lock()
+        self.tokens = multiprocessing.Value('d', float(burst), lock=False)
+        self.updated = multiprocessing.Value('d', time.time(), lock=False)
+
+    def acquire(self, url: str) -> None:
+        """
+        Wait until a request is allowed. All hosts share the bucket.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens.value = min(self.burst, self.tokens.value + (now - self.updated.value) * self.rate)
+                self.updated.value = now
+                if self.tokens.value >= 1:
+                    self.tokens.value -= 1
+                    return
+                wait = (1 - self.tokens.value) / self.rate
+            time.sleep(wait)
+
+
+class FetchClient:
+    """
+    A reusable HTTP client that owns a pool of keep-alive connections.
+
+    Failed requests (timeouts, dropped connections, 429 and 5xx responses) are retried
+    with exponential backoff and jitter; a Retry-After header sent by the server takes precedence.
+    Every attempt, retries included, is subject to the client's per-host rate limit.
+    The client is thread-safe, so one instance can serve a pool of download threads.
+    """
+
+    def __init__(self, proxies: Optional[Dict] = None, headers: Optional[Dict] = None,
+                 pool_size: int = 10, keep_alive: bool = True, max_retries: int = 4,
+                 backoff_factor: float = 0.5, backoff_max: float = 60.0, timeout: float = 30.0,
+                 rate_limiter=None):
+        """
+        :param proxies: The proxies to route requests through; the local TOR proxy by default.
+        :param headers: The headers sent with every request.
+        :param pool_size: The number of connections kept open per host.
+        :param keep_alive: Reuse connections between requests.
+        :param max_retries: How many times a failed request is retried before giving up.
+        :param backoff_factor: The delay (in seconds) before the first retry; it doubles with every retry.
+        :param backoff_max: The longest delay (in seconds) between two attempts.
+        :param timeout: The default connect/read timeout (in seconds) of a request.
+        :param rate_limiter: The RateLimiter (or SharedRateLimiter) every attempt must pass; the politeness defaults if None.
+        """
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        self.session = Session()
+        self.session.proxies.update(DEFAULT_PROXIES if proxies is None else proxies)
+        self.session.headers.update(DEFAULT_HEADERS if headers is None else headers)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url: str, timeout: Optional[float] = None, headers: Optional[Dict] = None) -> Response:
+        """
+        Make an HTTP GET request to 'url', retrying transient failures.
+        Return the last response received, with the number of retries it took in its 'retries' attribute;
+        raise the last RequestException if no response was ever received.
+
+        :param url: The URL to download.
+        :param timeout: The timeout (in seconds) of this request, instead of the client's default.
+        :param headers: Extra headers for this request only.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(url)
+            try:
+                resp = self.session.get(url, timeout=timeout, headers=headers)
+            except (Timeout, ConnectionError):
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    resp.retries = attempt
+                    return resp
+                delay = retry_after(resp)
+                resp.close()
+                time.sleep(self.backoff(attempt) if delay is None else min(delay, self.backoff_max))
+            attempt += 1
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Return the delay (in seconds) before retry number 'attempt' (counting from 0):
+        exponential in the attempt, capped at backoff_max, with half of it randomised so that
+        clients that failed together don't all retry together.
+        """
+        delay = min(self.backoff_max, self.backoff_factor * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def close(self) -> None:
+        """
+        Close all pooled connections.
+        """
+        self.session.close()
+
+
+def retry_after(resp: Response) -> Optional[float]:
+    """
+    Return the number of seconds the server asked us to wait in its Retry-After header, if any.
+    The header holds either a number of seconds or an HTTP date.
+    """
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+_client = None  # type: Optional[FetchClient]
+
+
+def get_client() -> FetchClient:
+    """
+    Return the client shared by all fetch functions, creating it with the default settings on first use.
+    """
+    global _client
+    if _client is None:
+        _client = FetchClient()
+    return _client
+
+
+def set_client(client: FetchClient) -> None:
+    """
+    Replace the client shared by all fetch functions, e.g. to change its timeouts, retries or proxies.
+    """
+    global _client
+    if _client is not None and _client is not client:
+        _client.close()
+    _client = client
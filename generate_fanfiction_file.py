@@ -1,9 +1,10 @@
+import logging
 import os
-from requests import get, Session
 from requests.exceptions import RequestException
 from contextlib import closing
-from bs4 import BeautifulSoup, Tag, NavigableString
-from typing import List, Dict, Optional, Any
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from bs4.element import PreformattedString
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple
 from collections import OrderedDict
 from reportlab.pdfgen import canvas
 from reportlab.lib.enums import TA_JUSTIFY, TA_CENTER
@@ -13,75 +14,224 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.lib.fonts import addMapping
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
 from reportlab.graphics.shapes import Drawing, Line
-import sys
-sys.setrecursionlimit(3000)
+from fetch import get_client
+from markup import tag_markup, translate, translate_string
+from cache import get_cache, conditional_headers, story_key, atomic_path
+from checkpoint import Checkpoints
+from chapter_store import ChapterText
+from instrument import Recorder, get_recorder, set_recorder
+from dedup import dedupe_paragraphs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from itertools import chain, islice
+from threading import Lock, Thread
+from html import unescape
+from xml.sax.saxutils import escape, quoteattr
+import asyncio
+import re
+
+logger = logging.getLogger(__name__)
+
 
 # Download web pages to get the raw HTML, with the help of the requests package
-def simple_get(url:str):
+def simple_get(url:str, timeout: Optional[float] = None, revalidate: bool = False):
     """
     Attempts to get the content at 'url' by making an HTTP GET request.
     If the content-type of response is some kind of HTML/XML, return the text content, otherwise return None.
+    The request goes through the shared FetchClient, so connections are reused and transient failures retried.
+    Chapters are served from the ChapterCache while fresh, and revalidated with a conditional request once stale.
+    Each call is recorded as a 'fetch' stage run.
+
+    :param url: The URL to download.
+    :param timeout: The timeout (in seconds) of this request, instead of the client's default.
+    :param revalidate: Ask the server whether a cached copy is still current, even if it is fresh.
     """
-    # Session().proxies['http'] = 'socks5://localhost:9150'  # 9150 for browser; 9050 for TOR service
-    proxy = {'https': 'socks5://localhost:9150'}
-    # print(Session().headers)
-    headers = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                             ' (KHTML, like Gecko) Chrome/89.0.4389.90 Safari/537.36'}
-    try:
-        #The closing() function ensures that any network resources are freed when they go out of scope in the with block.
-        #Using closing() is a good practice to help prevent fatal errors and network timeouts
-        with closing(Session().get(url, headers=headers, proxies=proxy, stream=True)) as resp:
-            if is_good_response(resp):
-                print("HTTP Error: {0}".format(resp.raise_for_status()))
-                print(resp.headers)
-                #the content is the HTML document
-                return resp.content
-            else:
-                return None
+    recorder = get_recorder()
+    with recorder.timer('fetch', **get_labels(url)) as record:
+        cache = get_cache()
+        entry = cache.load(url) if cache is not None else None
+        if entry is not None and (cache.offline or (cache.is_fresh(entry) and not revalidate)):
+            record['source'] = 'cache'
+            recorder.count('cache_hits')
+            return entry.content
+        if cache is not None and cache.offline:
+            log_error('Offline: {0} is not in the cache'.format(url))
+            return None
+
+        try:
+            headers = conditional_headers(entry) if entry is not None else None
+            resp = get_client().get(url, timeout=timeout, headers=headers)
+            with closing(resp):
+                record['status'] = resp.status_code
+                record['retries'] = resp.retries
+                recorder.count('requests', resp.retries + 1)
+                recorder.count('retries', resp.retries)
+                if entry is not None and resp.status_code == 304:
+                    record['source'] = 'revalidated'
+                    recorder.count('cache_revalidations')
+                    return cache.revalidated(url, entry).content
+                if is_good_response(resp):
+                    #the content is the HTML document
+                    content = resp.content
+                    record['source'] = 'network'
+                    record['bytes'] = len(content)
+                    recorder.count('bytes', len(content))
+                    if cache is not None:
+                        cache.store(url, content, resp.headers)
+                    return content
+                else:
+                    log_error('HTTP {0} from {1}'.format(resp.status_code, url))
+                    return None
 
-    except RequestException as e:
-        log_error('Error during requests to {0} : {1}'.format(url, str(e)))
-        return None
+        except RequestException as e:
+            record['error'] = type(e).__name__
+            log_error('Error during requests to {0} : {1}'.format(url, str(e)))
+            return None
 
 
 def is_good_response(resp)-> bool:
     """
      Return True if the response seems to be HTML, otherwise return False.
     """
-    content_type = resp.headers['Content-Type'].lower()
-    print("HTTP Status Code: {0}".format(resp.status_code))
-    return (resp.status_code == 200 and content_type is not None and content_type.find('html') > -1)
+    content_type = resp.headers.get('Content-Type', '').lower()
+    return (resp.status_code == 200 and content_type.find('html') > -1)
 
 
 def log_error(e):
     """
-    This function prints the errors.
+    This function logs the errors.
     """
-    print(e)
+    logger.warning(e)
 
 
-def get_num_of_chapters(url: str) -> int:
+# The parts of a fanfic page the scraper reads: fandom links, profile, chapter menu and story text.
+# Everything else (scripts, ads, navigation, reviews) is skipped by the parser instead of being built into the tree
+PAGE_PARTS = SoupStrainer(id=['pre_story_links', 'profile_top', 'chap_select', 'storytext', 'storycontext'])
+# The charset a page declares: <meta charset="utf-8"> or <meta http-equiv="Content-Type" content="...; charset=utf-8">
+META_CHARSET = re.compile(rb'''<meta[^>]+charset\s*=\s*["']?([\w.:-]+)''', re.I)
+
+
+def decode_page(content: bytes) -> str:
     """
-    Return the total number of chapters in the fanfic.
+    Return the HTML of a page as text, decoded once with the charset it declares (UTF-8 if none),
+    so the parser doesn't have to guess the encoding. Undecodable bytes become U+FFFD.
+    """
+    match = META_CHARSET.search(content, 0, 4096)
+    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return content.decode(encoding, errors='replace')
+    except LookupError: # an unknown charset name
+        return content.decode('utf-8', errors='replace')
 
-    :param url: The URL of a fanfic at any chapter.
-    :return: The total number of chapters in the fanfic.
+
+def parse_page(content: bytes) -> BeautifulSoup:
+    """
+    Parse the parts of a fanfic page listed in PAGE_PARTS with lxml.
+    """
+    return BeautifulSoup(decode_page(content), 'lxml', parse_only=PAGE_PARTS)
+
+
+def get_labels(url: str) -> Dict:
+    """
+    Return the labels identifying a page in the run report: its story id and chapter number if it has them.
     """
+    key = story_key(url)
+    if key is None:
+        return {'url': url}
+    return {'story': key[0], 'chapter': key[1]}
 
-    response = simple_get(url)
 
-    if response is not None:
-        html = BeautifulSoup(response, 'html.parser')
-        option_tags = html.find("select")
+class StoryPage:
+    """
+    A single page of a fanfic, downloaded and parsed once.
+
+    The first page of a story carries everything needed to build the front matter
+    (profile, chapter names, number of chapters) as well as the text of that chapter,
+    so it is shared between all of them instead of being fetched once per helper.
+    """
+
+    def __init__(self, url: str, response: Optional[bytes] = None):
+        """
+        :param url: The URL of a fanfic at any chapter.
+        :param response: The raw HTML of the page, if it was already downloaded.
+        """
+        if response is None:
+            response = simple_get(url)
+        if response is None:
+            #Raise an exception if we failed to get any data from the url
+            raise Exception('Error retrieving contents at {}'.format(url))
+        self.url = url
+        with get_recorder().timer('parse', **get_labels(url)):
+            self.html = parse_page(response)
+        self._profile = None  # type: Optional[Dict]
+
+    def get_num_of_chapters(self) -> int:
+        """
+        Return the total number of chapters in the fanfic.
+        """
+        option_tags = self.html.find("select")
         if option_tags is not None: #multi-chapter situation
-            values = [o.get('value') for o in option_tags.find_all("option")] # AttributeError: 'NoneType' object has no attribute 'find_all'; create a check for html.find("select") first. What does find() return?
+            values = [o.get('value') for o in option_tags.find_all("option")]
             return int(values[-1])
         else: #one-chapter situation
             return 1
-    else:
-        #Raise an exception if we failed to get any data from the url
-        raise Exception('Error retrieving contents at {}'.format(url))
+
+    def generate_links(self) -> List:
+        """
+        Return a list of links to all chapters of the fanfic, in chronological order.
+        """
+        num_chaps = self.get_num_of_chapters()
+        if num_chaps == 1:
+            return [self.url]
+        else:
+            link = slice_link(self.url)
+            return [link.format(n) for n in range(1, num_chaps + 1)]
+
+    def get_chap_name(self) -> List:
+        """
+        Get a list of all the chapter names/titles of the fanfic. Empty for a one-chapter fic.
+        """
+        option_tags = self.html.find("select", attrs={"id": "chap_select"})
+        if option_tags is not None: # multi-chapter situation
+            return [option.get_text() for option in option_tags.find_all("option")]
+        else: # one-chapter situation
+            return []
+
+    def get_profile(self) -> Dict:
+        """
+        Return the fanfic's profile dictionary. See get_profile().
+        """
+        if self._profile is None:
+            self._profile = parse_profile(self.html)
+        return self._profile
+
+    def get_text(self) -> List:
+        """
+        Return a list of all the paragraphs/lines in this page's chapter. HTML included.
+        Paragraphs the page repeats are only kept once, see dedupe_paragraphs().
+        """
+        with get_recorder().timer('extract', **get_labels(self.url)) as record:
+            story = self.html.find("div", attrs={"id": "storytext"})
+            if story is None:
+                story = self.html.find("div", attrs={"id": "storycontext"})
+            lst_text, duplicates = dedupe_paragraphs(list(iter_text(story)))
+            record['paragraphs'] = len(lst_text)
+            if duplicates:
+                record['duplicates'] = duplicates
+                get_recorder().count('duplicate_paragraphs', duplicates)
+        return lst_text
+
+
+def get_num_of_chapters(url: str) -> int:
+    """
+    Return the total number of chapters in the fanfic.
+
+    :param url: The URL of a fanfic at any chapter.
+    :return: The total number of chapters in the fanfic.
+    """
+    return StoryPage(url).get_num_of_chapters()
 
 
 def slice_link(url: str) -> str:
@@ -103,15 +253,7 @@ def generate_links(url: str) -> List:
     Return a list of links to all chapters of a fanfic, in chronological order.
     :param url: The URL of a fanfic at any chapter.
     """
-    num_chaps = get_num_of_chapters(url)
-    if num_chaps == 1:
-        return [url]
-    else:
-        link = slice_link(url)
-        lst = []
-        for n in range(1, num_chaps + 1):
-            lst.append(link.format(n)) #string format method
-        return lst
+    return StoryPage(url).generate_links()
 
 
 def get_title(url: str) -> str:
@@ -129,21 +271,7 @@ def get_chap_name(url: str) -> List:
     :param url:
     :return:
     """
-    response = simple_get(url)
-
-    if response is not None:
-        html = BeautifulSoup(response, 'html.parser')
-        option_tags = html.find("select", attrs={"id": "chap_select"})
-        if option_tags is not None: # multi-chapter situation
-            for option in option_tags:
-                text = option.get_text('|||') # ||| as a unique marker to later split by
-                lst_chap_names = text.split('|||')
-                return lst_chap_names
-        else: # one-chapter situation
-            return []
-    else:
-        # Raise an exception if we failed to get any data from the url
-        raise Exception('Error retrieving contents at {}'.format(url))
+    return StoryPage(url).get_chap_name()
 
 
 #Select and extract from the raw HTML using BeautifulSoup, to get text
@@ -151,24 +279,39 @@ def get_chap_name(url: str) -> List:
 # The object includes a lot of methods to select, view, and manipulatethe DOM nodes and text content
 #Extract the textual content of a chapter:
 
-def get_text_r_helper(line: BeautifulSoup) -> Any:
-        if isinstance(line, Tag) and line.name == 'p' or line.name == 'em' or line.name == 'strong':
-            stringify_replace = str(line).replace('<span style="text-decoration:underline;">', "<u>"). \
-                replace('<span style="text-decoration: underline;">', "<u>").replace("</span>", "</u>"). \
-                replace("\xa0", "").replace("<p></p>", "").replace('<br/>', "")
-            return stringify_replace
-        elif isinstance(line, NavigableString):
-            stringify_replace = str(line).replace("\xa0", "").replace('\n', "").strip()
-            return stringify_replace
-        else: # any other tag 
-            lst_text = []
-            for l in line:
-                temp = get_text_r_helper(l)
-                if isinstance(temp, list):
-                    lst_text.extend(temp)
-                else:
-                    lst_text.append(temp)
-            return lst_text
+# Tags that start a new paragraph. A tag containing one of them is walked into instead of kept whole,
+# e.g. <center><strong><em> ... <p> ... </p> or a <p> nested inside another <p>
+BLOCK_TAGS = ['p', 'div', 'center', 'blockquote']
+# Any tag of the paragraph markup
+TAGS = re.compile(r'<[^>]*>')
+
+
+def iter_text(story: Tag) -> Iterator[str]:
+    """
+    Yield the paragraphs/lines of a chapter's #storytext as ReportLab paragraph markup, in document order.
+    The tree is walked with an explicit stack rather than recursion, so deeply nested author HTML
+    can't overflow the call stack, and paragraphs are produced one at a time. Formatting of the
+    containers that are walked into (e.g. <strong> around several <p>) is applied to every paragraph inside.
+    :param story: The #storytext div.
+    """
+    # (node, markup opening the enclosing formatting, markup closing it)
+    stack = [(line, '', '') for line in reversed(story.contents)]
+    while stack:
+        line, opening, closing = stack.pop()
+        if isinstance(line, Tag):
+            if line.find(BLOCK_TAGS) is None:
+                text = translate(line)
+            else: # walk into its children
+                tag_opening, tag_closing = tag_markup(line)
+                opening, closing = opening + tag_opening, tag_closing + closing
+                stack.extend((child, opening, closing) for child in reversed(line.contents))
+                continue
+        elif isinstance(line, PreformattedString): # comments, CDATA, doctypes, ...
+            continue
+        else:
+            text = translate_string(line)
+        if text:
+            yield opening + text + closing
 
 
 def get_text_r(url: str) -> List:
@@ -176,25 +319,180 @@ def get_text_r(url: str) -> List:
     Downloads the fanfiction page and returns a list of all the paragraphs/lines in a chapter. HTML included.
     r stands for recursively.
     """
-    lst_text = []
-    response = simple_get(url)
-    if response is not None:
-        html = BeautifulSoup(response, 'lxml')
-        story = html.find("div", attrs={"id": "storytext"})
-        if story is None:
-            story = html.find("div", attrs={"id": "storycontext"})
-        for line in story:
-            temp = get_text_r_helper(line)
-            if isinstance(temp, list):
-                lst_text.extend(temp)
-            else:
-                lst_text.append(temp)
-    else:
-        #Raise an exception if we failed to get any data from the url
-        raise Exception('Error retrieving contents at {}'.format(url))
-    lst_text = list(filter(None, lst_text))
-    print(lst_text)
-    return lst_text
+    return StoryPage(url).get_text()
+
+
+# Chapters are downloaded by this many threads at once; the FetchClient's rate limit keeps them polite
+MAX_WORKERS = 8
+
+
+def imap_chapters(func, lst_chap_links: List, max_workers: int = MAX_WORKERS) -> Iterator:
+    """
+    Apply func (e.g. get_text_r) to every chapter link concurrently, with at most max_workers
+    downloads in flight, and yield the results in the same order as the links as soon as each is ready.
+    At most 2 * max_workers results are held ahead of the consumer, so a slow consumer (e.g. PDF layout)
+    doesn't make every chapter pile up in memory.
+    :param func: A function taking the URL of a chapter.
+    :param lst_chap_links: The links to the chapters.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    """
+    if max_workers <= 1 or len(lst_chap_links) <= 1:
+        for link in lst_chap_links:
+            yield func(link)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(lst_chap_links))) as executor:
+        pending = deque()
+        links = iter(lst_chap_links)
+        for link in islice(links, 2 * max_workers):
+            pending.append(executor.submit(func, link))
+        while pending:
+            result = pending.popleft().result()
+            for link in islice(links, 1):
+                pending.append(executor.submit(func, link))
+            yield result
+
+
+def map_chapters(func, lst_chap_links: List, max_workers: int = MAX_WORKERS) -> List:
+    """
+    Apply func (e.g. get_text_r) to every chapter link concurrently, with at most max_workers
+    downloads in flight. Return the results in the same order as the links.
+    :param func: A function taking the URL of a chapter.
+    :param lst_chap_links: The links to the chapters.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    """
+    return list(imap_chapters(func, lst_chap_links, max_workers))
+
+
+def extract_chapter(url: str, content: bytes) -> Tuple[List, List[Dict], Dict]:
+    """
+    Parse a downloaded chapter page and return its paragraphs (see get_text_r()), in an extraction process.
+    The 'parse' and 'extract' stage records and the counters of this run are returned with them,
+    for the parent process's recorder.
+    """
+    recorder = Recorder()
+    set_recorder(recorder)
+    return StoryPage(url, content).get_text(), recorder.records, recorder.counters
+
+
+def pipeline_chapters(lst_chap_links: List, done: Optional[Dict[str, List]] = None, max_workers: int = MAX_WORKERS,
+                      processes: Optional[int] = None, queue_size: Optional[int] = None) -> Iterator[List]:
+    """
+    Yield the paragraphs of every chapter, in the same order as the links, from a pipeline of stages
+    connected by bounded queues:
+
+    fetch: max_workers downloads in flight, driven by an asyncio event loop in a background thread
+        (simple_get runs in a thread of its own, as requests blocks);
+    extract: get_text_r's parsing and translation, in a pool of processes, so it runs beside the consumer
+        (e.g. PDF layout) instead of competing with it for the GIL;
+    assemble: the chapters put back in order, for the consumer.
+
+    A full queue holds up the stage feeding it, and links are only handed out to the fetch stage while fewer than
+    queue_size chapters are waiting for the consumer, so even a chapter stuck in retries doesn't let the chapters
+    after it pile up in memory.
+    Failures are raised when the consumer reaches the chapter that failed, like imap_chapters does.
+    :param lst_chap_links: The links to the chapters.
+    :param done: The paragraphs of chapters already extracted, by link; they are not fetched again.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    :param processes: The number of extraction processes; defaults to the number of cores.
+    :param queue_size: The capacity of each queue between stages; defaults to 2 * max_workers.
+    """
+    done = done or {}
+    processes = processes or os.cpu_count() or 1
+    queue_size = queue_size or 2 * max_workers
+    loop = asyncio.new_event_loop()
+    fetch_executor = ThreadPoolExecutor(max_workers=max_workers)
+    extract_executor = ProcessPoolExecutor(max_workers=processes)
+    links = iter([(index, link) for index, link in enumerate(lst_chap_links) if link not in done])
+    fetched = extracted = None  # type: Optional[asyncio.Queue]
+    window = None  # type: Optional[asyncio.Semaphore]
+    extracting = processes
+
+    async def fetch():
+        while True:
+            # A slot is freed whenever the consumer takes a chapter
+            await window.acquire()
+            item = next(links, None) # shared by all the fetchers, so they take the links in order
+            if item is None:
+                window.release()
+                return
+            index, link = item
+            try:
+                content = await loop.run_in_executor(fetch_executor, simple_get, link)
+            except Exception as e: # e.g. an OSError storing the page in the cache
+                content = e
+            if content is None:
+                content = Exception('Error retrieving contents at {}'.format(link))
+            await fetched.put((index, link, content))
+
+    async def fetch_all():
+        stopped = False
+        try:
+            await asyncio.gather(*[fetch() for _ in range(max_workers)])
+        except asyncio.CancelledError: # the pipeline is being stopped, nothing reads the queues any more
+            stopped = True
+            raise
+        finally:
+            if not stopped:
+                for _ in range(processes):
+                    await fetched.put(None) # no more pages
+
+    async def extract():
+        nonlocal extracting
+        while True:
+            item = await fetched.get()
+            if item is None:
+                extracting -= 1
+                if extracting == 0:
+                    await extracted.put((None, None)) # no more chapters
+                return
+            index, link, content = item
+            if not isinstance(content, Exception):
+                try:
+                    content = await loop.run_in_executor(extract_executor, extract_chapter, link, content)
+                except Exception as e:
+                    content = e
+            await extracted.put((index, content))
+
+    async def start() -> List[asyncio.Task]:
+        nonlocal fetched, extracted, window
+        # The queues belong to the loop they are used in, so they are made in it
+        fetched, extracted, window = asyncio.Queue(queue_size), asyncio.Queue(queue_size), asyncio.Semaphore(queue_size)
+        return [loop.create_task(fetch_all())] + [loop.create_task(extract()) for _ in range(processes)]
+
+    async def stop(tasks: List[asyncio.Task]) -> None:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    tasks = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    try:
+        # Assemble: chapters that arrive early wait in 'ready' until the consumer gets to them
+        ready = {}
+        for index, link in enumerate(lst_chap_links):
+            if link in done:
+                yield done[link]
+                continue
+            while index not in ready:
+                arrived, result = asyncio.run_coroutine_threadsafe(extracted.get(), loop).result()
+                if arrived is None: # every stage is done, yet this chapter never came through
+                    raise Exception('Error retrieving contents at {}'.format(link))
+                ready[arrived] = result
+            result = ready.pop(index)
+            if isinstance(result, Exception):
+                raise result
+            loop.call_soon_threadsafe(window.release)
+            paragraphs, records, counters = result
+            get_recorder().merge(records, counters)
+            yield paragraphs
+    finally:
+        asyncio.run_coroutine_threadsafe(stop(tasks), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        fetch_executor.shutdown(wait=False)
+        extract_executor.shutdown(cancel_futures=True)
 
 
 # def get_text(url: str)-> List:
@@ -239,123 +537,80 @@ def get_profile(url: str) -> Dict:
     """
     Return a dictionary containing the fanfiction's profile information
     i.e. title, author, publication date, number of chapters, total words,
-    fandom, characters, genre, rating, updated date, summary,  ...
+    fandom, characters, genre, rating, updated date, summary, language,
+    reviews, favs, follows, status and story id, plus the update and publication
+    times as timestamps ('updated_at', 'published_at'; None if not shown).
 
     :param url: The URL of a fanfic at any chapter.
     """
+    return StoryPage(url).get_profile()
+
+
+# The genres fanfiction.net lets authors pick (two-genre stories show e.g. 'Hurt/Comfort')
+GENRES = frozenset(['Adventure', 'Angst', 'Crime', 'Drama', 'Family', 'Fantasy', 'Friendship', 'General', 'Horror',
+                    'Humor', 'Hurt', 'Comfort', 'Mystery', 'Parody', 'Poetry', 'Romance', 'Sci-Fi', 'Spiritual',
+                    'Supernatural', 'Suspense', 'Tragedy', 'Western'])
+# Labelled fields of the stats line ('Rated: Fiction T - English - ... - Words: 12,345 - ... - id: 8099181')
+# and the profile keys they fill
+STATS_LABELS = {'Rated': 'rating', 'Chapters': 'chapters', 'Words': 'words', 'Reviews': 'reviews',
+                'Favs': 'favs', 'Follows': 'follows', 'Updated': 'updated_date', 'Published': 'publication_date',
+                'Status': 'status', 'id': 'story_id'}
+STATS_FIELD = re.compile(r'^({}):\s*(.*)$'.format('|'.join(STATS_LABELS)), re.DOTALL)
+# The dates of the stats line, whose spans hold their time as epoch seconds (data-xutime), and the profile keys
+# of those times
+STATS_TIME_LABELS = {'Updated': 'updated_at', 'Published': 'published_at'}
+STATS_TIME = re.compile(r'({}):\s*$'.format('|'.join(STATS_TIME_LABELS)))
+
+
+def parse_profile(html: BeautifulSoup) -> Dict:
+    """
+    Return the profile dictionary (see get_profile()) from an already parsed fanfic page.
 
-    response = simple_get(url)
-
-    if response is not None:
-        html = BeautifulSoup(response, 'html.parser')
-        profile = html.find(id="profile_top")
-
-        # Getting the values for the dictionary
-        # Main values
-        title = profile.find("b").get_text()
-        author = profile.find("a").get_text()
-        author_link = "https://www.fanfiction.net/" + profile.find("a").get('href')
-        summary = profile.find("div", attrs={"class": "xcontrast_txt"}).get_text()
-        fandom = html.find("span", attrs={"class": "lc-left"}).find_all("a")[-1].get_text()
-        # Stats
-        rating = profile.find("span", attrs={"class": "xgray"}).find("a").get_text()
-        lst_dates = profile.find("span", attrs={"class": "xgray"}).find_all("span")
-        # Someimtes there are is an updated date, sometimes there isn't one
-        if len(lst_dates) != 1:
-            updated_date = lst_dates[0].get_text()
-            publication_date = lst_dates[1].get_text()
+    The stats line is read field by field: labelled fields ('Words: 12,345') by their label,
+    so their order doesn't matter and any of them may be missing. Of the unlabelled ones,
+    the first is the language, genres are recognised against GENRES, and the rest are the characters.
+    :param html: The parsed HTML of a fanfic at any chapter.
+    """
+    profile = html.find(id="profile_top")
+    author_tag = profile.find("a")
+    stats_tag = profile.find("span", attrs={"class": "xgray"})
+
+    # Main values
+    profile_dict = {'title': profile.find("b").get_text(),
+                    'author': author_tag.get_text(),
+                    'summary': profile.find("div", attrs={"class": "xcontrast_txt"}).get_text(),
+                    'fandom': html.find("span", attrs={"class": "lc-left"}).find_all("a")[-1].get_text(),
+                    'author_link': "https://www.fanfiction.net/" + author_tag.get('href').lstrip('/'),
+                    # Defaults of the fields a story may not have
+                    'genre': '', 'characters': '', 'language': '', 'chapters': '1', 'updated_date': '',
+                    'reviews': '0', 'favs': '0', 'follows': '0', 'story_id': '', 'status': 'In-Progress',
+                    'updated_at': None, 'published_at': None}
+
+    # Stats: a string containing rating, language, genre, characters, words, status, and more ...
+    unlabelled = []
+    for field in stats_tag.get_text().split(" - "):
+        field = field.strip()
+        match = STATS_FIELD.match(field)
+        if match is not None:
+            profile_dict[STATS_LABELS[match.group(1)]] = match.group(2).strip()
+        elif field:
+            unlabelled.append(field)
+    if unlabelled:
+        profile_dict['language'] = unlabelled.pop(0)
+    characters = []
+    for field in unlabelled:
+        if not profile_dict['genre'] and all(genre in GENRES for genre in field.split("/")):
+            profile_dict['genre'] = field
         else:
-            publication_date = lst_dates[0].get_text()
-            updated_date = '' # empty string '' evaluates to False (is falsy, but not equal to False)
-
-        # a string containing rating, genre, characters, words, status, and more ...
-        stats = profile.find("span", attrs={"class": "xgray"}).get_text()
-        # print(stats)
-        stats_split = stats.split(" - ")
-        # print(stats_split)
-        for i in range(len(stats_split)):
-            stats_split[i] = stats_split[i].lstrip()
-
-        # check for existence of certain profile keys i.e. genre, characters, chapters, and status
-        genres = ['Adventure', 'Angst', 'Crime', 'Drama', 'Family', 'Fantasy', 'Friendship', 'General', 'Horror',
-                  'Humor',
-                  'Hurt', 'Comfort', 'Mystery', 'Parody', 'Poetry', 'Romance', 'Sci-Fi', 'Spiritual', 'Supernatural',
-                  'Suspense',
-                  'Tragedy', 'Western']
-
-        # Checking to see if the fanfic is one-chapter or more
-        option_tags = html.find("select")
-        if option_tags is not None:  # multi-chapter fic; profile key 'Chapters' exist
-            if stats_split[2].split("/")[0] in genres:
-                genre = stats_split[2]
-                if "Chapters:" in stats_split[3]:
-                    characters = ''
-                    chapters = stats_split[3].split(":")[1].strip()
-                    words_split = stats_split[4].split(":")
+            characters.append(field)
+    profile_dict['characters'] = " - ".join(characters)
 
-                else:
-                    characters = stats_split[3]
-                    chapters = stats_split[4].split(":")[1].strip()
-                    words_split = stats_split[5].split(":")
-
-            else:   # genre doesn't exist
-                if "Chapters:" in stats_split[2]:
-                    characters = ''
-                    chapters = stats_split[2].split(":")[1].strip()
-                    words_split = stats_split[3].split(":")
-
-                else:
-                    characters = stats_split[2]
-                    chapters = stats_split[3].split(":")[1].strip()
-                    words_split = stats_split[4].split(":")
-
-                genre = ''
-        else: # single chapter fic; "Chapters' profile key DNE
-            chapters = "1"
-            if stats_split[2].split("/")[0] in genres:
-                genre = stats_split[2]
-                if "Words:" in stats_split[3]:
-                    characters = ''
-                    words_split = stats_split[3].split(":")
-                else:
-                    characters = stats_split[3]
-                    words_split = stats_split[4].split(":")
-            else:
-                if "Words:" in stats_split[2]:
-                    characters = ''
-                    words_split = stats_split[2].split(":")
-                else:
-                    characters = stats_split[2]
-                    words_split = stats_split[3].split(":")
-                genre = ''
-        words = words_split[1]
-
-        if "Status: Complete" in stats_split:
-            status = "Complete"
-        else:
-            status = "In-Progress"
-
-        # Create dictionary
-        profile_dict = {'title': title,
-                        'author': author,
-                        'summary': summary,
-                        'fandom': fandom,
-                        'rating': rating,
-                        'updated_date': updated_date,
-                        'publication_date': publication_date,
-                        'genre': genre,
-                        'characters': characters,
-                        'chapters': chapters,
-                        'words': words,
-                        'status': status,
-                        'author_link': author_link
-                        }
-        # print(profile_dict)
-        return profile_dict
-
-    else:
-        #Raise an exception if we failed to get any data from the url
-        raise Exception('Error retrieving contents at {}'.format(url))
+    # The dates are shown as '8h ago' or 'May 13' when recent, but their spans hold the exact time
+    for time_tag in stats_tag.find_all("span", attrs={"data-xutime": True}):
+        label = STATS_TIME.search(str(time_tag.previous_sibling or ''))
+        if label is not None and time_tag['data-xutime'].isdigit():
+            profile_dict[STATS_TIME_LABELS[label.group(1)]] = int(time_tag['data-xutime'])
+    return profile_dict
 
 
 def get_path(filename: str) -> str:
@@ -369,76 +624,219 @@ def get_path(filename: str) -> str:
     return path
 
 
-def register_fonts() -> None:
+class Chapter:
     """
-    Register the desired font to be used in the PDF.
+    One chapter of a fanfic: its number, name, link and paragraphs (ReportLab paragraph markup, see iter_text()).
+    The paragraphs are a ChapterText, or any list of str.
     """
-    pdfmetrics.registerFont(TTFont('Georgia', 'fonts\Georgia Regular font.ttf'))
-    pdfmetrics.registerFont(TTFont('Georgia Italic', 'fonts\georgia italic.ttf'))
-    pdfmetrics.registerFont(TTFont('Georgia Bold', 'fonts\georgia bold.ttf'))
-    pdfmetrics.registerFont(TTFont('Georgia Bold Italic', 'fonts\Georgia Bold Italic font.ttf'))
 
-    # 2nd positional param is bool flag for italic
-    # 3rd positional param is bool flag for boldface
-    addMapping('Georgia', 0, 0, 'Georgia')
-    addMapping('Georgia', 0, 1, 'Georgia Italic')
-    addMapping('Georgia', 1, 0, 'Georgia Bold')
-    addMapping('Georgia', 1, 1, 'Georgia Bold Italic')
+    def __init__(self, number: int, name: str, link: str, paragraphs: Iterable[str]):
+        self.number = number
+        self.name = name
+        self.link = link
+        self.paragraphs = paragraphs
 
 
-def generate_pdf(url: str) -> None:
+class Fanfic:
     """
-    Generate the PDF file from the given URL.
-    :param url: A link to a fanfiction on a site such as fanfiction.net.
+    The in-memory model of a fanfic that all writers (PDF, text, EPUB, HTML) render from:
+    its profile dictionary and its chapters, in order.
+
+    Chapters are downloaded the first time they are iterated over, concurrently and ahead of the consumer,
+    so the first writer can lay out early chapters while later ones download. They are then kept,
+    so further writers (other formats) cost no extra scraping. Kept chapters are compact ChapterText buffers
+    and, once checkpointed, are read back from their checkpoint files as needed rather than held in memory,
+    so memory grows with the chapter being written rather than with the story.
+
+    Each chapter is also checkpointed to disk as soon as it is extracted (see checkpoint.Checkpoints),
+    so if the build fails part way, the next one resumes after the last good chapter.
+    Call clear_checkpoints() once every output is written.
     """
-    register_fonts()
-    # Styling
-    style = ParagraphStyle(
-        name="Normal",
-        fontSize=11.5,
-        fontName="Georgia",
-        leading=14.5
-    )
-    h1 = ParagraphStyle(
-        name='Heading1',
-        fontSize=14,
-        leading=16,
-        fontName="Georgia Bold",
-        alignment=TA_CENTER
-    )
-    h2 = ParagraphStyle(
-        name='Heading2',
-        fontSize=12.5,
-        leading=16,
-        fontName="Georgia",
-        alignment=TA_CENTER
-    )
-
-    # Create the document
-    path = get_path(get_title(url) + '.pdf') # SimpleDocTemplate will take this as a parameter
-    # and create a pdf file in the folder specified by get_path() with the specified name
-    doc = SimpleDocTemplate(path, pagesize=letter,
-                            rightMargin=72, leftMargin=72,
-                            topMargin=40, bottomMargin=40)
 
-    Story = []
+    def __init__(self, url: str, max_workers: int = MAX_WORKERS, extract_processes: int = 0, checkpoint: bool = True):
+        """
+        :param url: A link to a fanfiction on a site such as fanfiction.net.
+        :param max_workers: The maximum number of chapters downloaded at the same time.
+        :param extract_processes: If more than 0, chapters are parsed by this many processes
+        instead of the download threads (see pipeline_chapters()).
+        :param checkpoint: Checkpoint the extracted chapters, and resume from the checkpoints of an earlier build.
+        """
+        # The given page is fetched once and shared by the profile, the chapter list and its own chapter
+        page = StoryPage(url)
+        self.url = url
+        self.title = get_title(url)
+        self.profile = page.get_profile()
+        self.chap_names = page.get_chap_name()
+        self.chap_links = page.generate_links()
+        self.chapters = []  # type: List[Chapter]
+
+        key = story_key(url)
+        self.checkpoints = Checkpoints(key[0], self.profile, self.chap_names) \
+            if checkpoint and key is not None else None
+        saved = self.checkpoints.load() if self.checkpoints is not None else {}
+        done = {self.chap_links[number - 1]: paragraphs for number, paragraphs in saved.items()
+                if number <= len(self.chap_links)}
+        if done:
+            get_recorder().count('resumed_chapters', len(done))
+
+        def get_chapter(link: str) -> List:
+            if link in done:
+                return done[link]
+            return page.get_text() if link == page.url else get_text_r(link)
+
+        if extract_processes > 0 and len(self.chap_links) > 1:
+            if page.url not in done:
+                done[page.url] = page.get_text()
+            self._pending = pipeline_chapters(self.chap_links, done, max_workers, extract_processes)
+        else:
+            self._pending = imap_chapters(get_chapter, self.chap_links, max_workers)
+
+    def iter_chapters(self) -> Iterator[Chapter]:
+        """
+        Yield the chapters in order, downloading the ones not downloaded yet.
+        """
+        i = 0
+        while True:
+            if i < len(self.chapters):
+                yield self.chapters[i]
+                i += 1
+            elif self._pending is None:
+                return
+            else:
+                try:
+                    paragraphs = next(self._pending)
+                except StopIteration:
+                    self._pending = None
+                    return
+                name = self.chap_names[i] if i < len(self.chap_names) else ''
+                if not isinstance(paragraphs, ChapterText):
+                    paragraphs = ChapterText.from_paragraphs(paragraphs)
+                    if self.checkpoints is not None:
+                        paragraphs = self.checkpoints.save(i + 1, paragraphs)
+                self.chapters.append(Chapter(i + 1, name, self.chap_links[i], paragraphs))
+
+    def clear_checkpoints(self) -> None:
+        """
+        Delete the checkpoints of this fanfic's chapters, once everything built from them is written.
+        The chapters can't be read after this.
+        """
+        if self.checkpoints is not None:
+            self.checkpoints.clear()
+
+
+# The fonts shipped in the fonts/ folder next to this file, by face name
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+FONT_FILES = {'Georgia': 'Georgia Regular font.ttf',
+              'Georgia Italic': 'georgia italic.ttf',
+              'Georgia Bold': 'georgia bold.ttf',
+              'Georgia Bold Italic': 'Georgia Bold Italic font.ttf'}
+# ReportLab's built-in CID fonts for the East Asian scripts the Georgia faces have no glyphs for,
+# in order of precedence: a paragraph with Hangul is Korean, one with kana is Japanese, and other Han text is Chinese
+CJK_FONTS = [('HYSMyeongJo-Medium', re.compile('[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]')),
+             ('HeiseiMin-W3', re.compile('[\u3040-\u30ff\u31f0-\u31ff]')),
+             ('STSong-Light', re.compile('[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]'))]
+# A tag of the paragraph markup, or a run of East Asian text (including CJK punctuation and fullwidth forms)
+CJK_RUN = re.compile('(<[^>]*>)|([\u1100-\u11ff\u2e80-\u30ff\u3130-\u318f\u31f0-\u31ff\u3400-\u4dbf'
+                     '\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+)')
+_registered_faces = set()
+_fonts_lock = Lock()
+
+# Styling, shared by every document
+style = ParagraphStyle(
+    name="Normal",
+    fontSize=11.5,
+    fontName="Georgia",
+    leading=14.5
+)
+h1 = ParagraphStyle(
+    name='Heading1',
+    fontSize=14,
+    leading=16,
+    fontName="Georgia Bold",
+    alignment=TA_CENTER
+)
+h2 = ParagraphStyle(
+    name='Heading2',
+    fontSize=12.5,
+    leading=16,
+    fontName="Georgia",
+    alignment=TA_CENTER
+)
+
+
+def register_fonts(faces: Iterable[str] = ('Georgia', 'Georgia Bold')) -> None:
+    """
+    Register the desired font faces to be used in the PDF. Each face's TTF file is only read
+    the first time it is registered in this process; by default only the faces of the styles are.
+    :param faces: Face names from FONT_FILES or CJK_FONTS.
+    """
+    with _fonts_lock:
+        for face in faces:
+            if face not in _registered_faces:
+                if face in FONT_FILES:
+                    pdfmetrics.registerFont(TTFont(face, os.path.join(FONT_DIR, FONT_FILES[face])))
+                else: # one of CJK_FONTS, which ReportLab doesn't need a file for
+                    pdfmetrics.registerFont(UnicodeCIDFont(face))
+                _registered_faces.add(face)
+                if len(_registered_faces) == 1:
+                    # 2nd positional param is bool flag for boldface
+                    # 3rd positional param is bool flag for italic
+                    addMapping('Georgia', 0, 0, 'Georgia')
+                    addMapping('Georgia', 0, 1, 'Georgia Italic')
+                    addMapping('Georgia', 1, 0, 'Georgia Bold')
+                    addMapping('Georgia', 1, 1, 'Georgia Bold Italic')
+
+
+def fallback_fonts(text: str) -> str:
+    """
+    Return paragraph markup with its runs of Chinese, Japanese or Korean text set in a font that has their glyphs
+    (see CJK_FONTS), registering that font on first use. Text in other scripts is returned unchanged.
+    """
+    face = next((face for face, script in CJK_FONTS if script.search(text)), None)
+    if face is None:
+        return text
+    register_fonts((face,))
+    font = '<font name="{}">'.format(face)
+    return CJK_RUN.sub(lambda match: match.group(1) or font + match.group(2) + '</font>', text)
 
-    # Load in data
-    lst_chap_names = get_chap_name(url)
-    lst_chap_links = generate_links(url)
-    profile_dict = get_profile(url)
+
+def make_paragraph(text: str, style: ParagraphStyle) -> Paragraph:
+    """
+    Return a Paragraph of the given markup, first registering the italic faces if the markup uses them.
+    East Asian text gets a fallback font, see fallback_fonts().
+    """
+    text = fallback_fonts(text)
+    if not _registered_faces.issuperset(FONT_FILES) and ('<i>' in text or '<em>' in text):
+        if '<b>' in text or '<strong>' in text or style.fontName == 'Georgia Bold':
+            register_fonts(('Georgia Italic', 'Georgia Bold Italic'))
+        else:
+            register_fonts(('Georgia Italic',))
+    return Paragraph(text, style=style)
+
+
+def front_matter_flowables(fanfic: Fanfic, toc_rects: Optional[List] = None) -> List:
+    """
+    Return the flowables of the front matter page: title, author, summary, source link, stats
+    and, for a multi-chapter fanfic, the contents, each line linking to its chapter.
+    :param fanfic: The fanfic.
+    :param toc_rects: If given, the contents lines don't link themselves but record where they were drawn
+    in this list (see ContentsLine), so links can be added once the chapters are merged in.
+    """
+    Story = []
+    lst_chap_links = fanfic.chap_links
+    profile_dict = fanfic.profile
 
     # Add fanfic title and the link to the original fanfic on Fanfiction.net
-    Story.append(Paragraph(profile_dict['title'], h1))
+    Story.append(make_paragraph(escape(profile_dict['title']), h1))
     Story.append(Spacer(1, 12))
     # Add fanfic author
-    Story.append(Paragraph("by " + "<font color='blue'><a href=" + profile_dict['author_link'] + "><u>" + profile_dict['author'] + "</u></a></font>", h2))
+    Story.append(make_paragraph("by " + "<font color='blue'><a href=" + quoteattr(profile_dict['author_link']) + "><u>" + escape(profile_dict['author']) + "</u></a></font>", h2))
     Story.append(Spacer(1, 12))
     Story.append(Spacer(1, 12))
     # Add fanfic summary
-    Story.append(Paragraph("<b>Summary</b>", style=style))
+    Story.append(make_paragraph("<b>Summary</b>", style=style))
     Story.append(Spacer(1, 12))
-    Story.append(Paragraph(profile_dict['summary'], style=style))
+    Story.append(make_paragraph(escape(profile_dict['summary']), style=style))
     Story.append(Spacer(1, 12))
     Story.append(Spacer(1, 12))
     Story.append(Spacer(1, 12))
@@ -447,77 +845,245 @@ def generate_pdf(url: str) -> None:
     d.add(Line(0, 20, 455, 20)) # (x1, y1, x2, y2)
     Story.append(d)
 
-    Story.append(Paragraph("Originally posted at: " + "<font color='blue'><a href=" + lst_chap_links[0] + "><u>"
-                           + lst_chap_links[0] + "</u></a></font>" + ".", style=style))
+    Story.append(make_paragraph("Originally posted at: " + "<font color='blue'><a href=" + quoteattr(lst_chap_links[0]) + "><u>"
+                           + escape(lst_chap_links[0]) + "</u></a></font>" + ".", style=style))
     Story.append(Spacer(1, 12))
     Story.append(Spacer(1, 12))
 
     # Add in fanfic stats
-    Story.append(Paragraph("<strong>Rating: </strong>" + profile_dict['rating'], style=style))
-    Story.append(Paragraph("<strong>Fandom: </strong>"+ profile_dict['fandom'], style=style))
+    Story.append(make_paragraph("<strong>Rating: </strong>" + escape(profile_dict['rating']), style=style))
+    Story.append(make_paragraph("<strong>Fandom: </strong>"+ escape(profile_dict['fandom']), style=style))
     if profile_dict["genre"]:
-        Story.append(Paragraph("<strong>Genre: </strong>" + profile_dict['genre'], style=style))
+        Story.append(make_paragraph("<strong>Genre: </strong>" + escape(profile_dict['genre']), style=style))
     if profile_dict["characters"]:
-        Story.append(Paragraph("<strong>Characters: </strong>" + profile_dict['characters'], style=style))
-    Story.append(Paragraph("<strong>Words: </strong>" + profile_dict['words'], style=style))
+        Story.append(make_paragraph("<strong>Characters: </strong>" + escape(profile_dict['characters']), style=style))
+    Story.append(make_paragraph("<strong>Words: </strong>" + escape(profile_dict['words']), style=style))
     if profile_dict["chapters"]:
-        Story.append(Paragraph("<strong>Chapters: </strong>" + profile_dict['chapters'], style=style))
-    Story.append(Paragraph("<strong>Published on: </strong>" + profile_dict['publication_date'], style=style))
+        Story.append(make_paragraph("<strong>Chapters: </strong>" + escape(profile_dict['chapters']), style=style))
+    Story.append(make_paragraph("<strong>Published on: </strong>" + escape(profile_dict['publication_date']), style=style))
     if profile_dict["updated_date"]:
-        Story.append(Paragraph("<strong>Updated on: </strong>" + profile_dict['updated_date'], style=style))
-    Story.append(Paragraph("<strong>Status: </strong>" + profile_dict['status'], style=style))
+        Story.append(make_paragraph("<strong>Updated on: </strong>" + escape(profile_dict['updated_date']), style=style))
+    Story.append(make_paragraph("<strong>Status: </strong>" + escape(profile_dict['status']), style=style))
 
-
-    Story.append(PageBreak())
-    # Add in the fanfic
-    for i in range(len(lst_chap_links)):
+    # Add in the contents
+    if len(fanfic.chap_names) > 1:
         Story.append(Spacer(1, 12))
-        if lst_chap_names:
-            Story.append(Paragraph(lst_chap_names[i], h1))
         Story.append(Spacer(1, 12))
+        Story.append(make_paragraph("<b>Contents</b>", style=style))
         Story.append(Spacer(1, 12))
-        lst_paragraphs = get_text_r(lst_chap_links[i])
-        for paragraph in lst_paragraphs:
-            Story.append(Paragraph(paragraph, style=style))
-            Story.append(Spacer(1, 12))
-        if len(lst_chap_links) - 1 != i:
-            Story.append(PageBreak())
+        for number, name in enumerate(fanfic.chap_names, 1):
+            if toc_rects is None:
+                Story.append(make_paragraph("<a href='#chapter-{0}' color='blue'>{1}</a>".format(number, escape(name)),
+                                       style=style))
+            else:
+                Story.append(ContentsLine(escape(name), style, number=number, rects=toc_rects))
+    return Story
 
-    Story.append(Spacer(1, 12))
-    doc.build(Story)
 
+def write_pdf(fanfic: Fanfic, path: str) -> None:
+    """
+    Write the fanfic to a PDF file: a front matter page with its profile, then one chapter per page.
+    :param fanfic: The fanfic.
+    :param path: The PDF file to create.
+    """
+    register_fonts()
 
-def generate_text_file(url: str) -> None:
+    Story = front_matter_flowables(fanfic)
+    Story.append(PageBreak())
+    # Add in the fanfic. The chapters' flowables are only created as the layout reaches them,
+    # while the following chapters are still being downloaded (so the layout stage includes that wait).
+    # The document is built in a temporary file that only replaces 'path' once complete
+    with get_recorder().timer('layout', story=get_labels(fanfic.url).get('story')), \
+            atomic_path(path) as tmp_path:
+        doc = SimpleDocTemplate(tmp_path, pagesize=letter,
+                                rightMargin=72, leftMargin=72,
+                                topMargin=40, bottomMargin=40)
+        doc.build(FlowableStream(chain(Story, iter_chapter_flowables(fanfic, style, h1))))
+
+
+def generate_pdf(url: str, max_workers: int = MAX_WORKERS, extract_processes: int = 0) -> None:
     """
-    Generate a text file from the given URL.
+    Generate the PDF file from the given URL.
     :param url: A link to a fanfiction on a site such as fanfiction.net.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    :param extract_processes: If more than 0, chapters are parsed by this many processes while the PDF is laid out.
     """
-    lst_chap_links = generate_links(url)
-    with open("fanfiction.txt", "a", encoding="utf-8") as file_object:
-        for i in range(len(lst_chap_links)):
-            response = simple_get(lst_chap_links[i])
-            if response is not None:
-                html = BeautifulSoup(response, 'lxml')
-                story = html.find("div", attrs={"id": "storytext"})
-                # print(type(story))
-                # Destroy/decompose the 'strong tags' in the scraped html (those correspond to Author Notes in this fanfic)
-                destroy_tags = html.find("div", attrs={"id": "storytext"}).find_all("strong")
-                for destroy_tag in destroy_tags:
-                    destroy_tag.decompose()
-                # print(story)
-                if story is None:
-                    story = html.find("div", attrs={"id": "storycontext"}).text
-            else:
-                # Raise an exception if we failed to get any data from the url
-                raise Exception('Error retrieving contents at {}'.format(url))
-            file_object.write(story.text)
-            # lst_paragraphs = get_text_r(lst_chap_links[i])
-            # for paragraph in lst_paragraphs:
-            #     file_object.write(paragraph)
+    fanfic = Fanfic(url, max_workers, extract_processes)
+    # SimpleDocTemplate will create a pdf file in the folder specified by get_path() with the specified name
+    write_pdf(fanfic, get_path(fanfic.title + '.pdf'))
+    fanfic.clear_checkpoints()
+
+
+def iter_chapter_flowables(fanfic: Fanfic, style: ParagraphStyle, h1: ParagraphStyle) -> Iterator:
+    """
+    Yield the flowables of every chapter of the fanfic, in order: its name, its paragraphs and a page break.
+    :param fanfic: The fanfic.
+    :param style: The style of the paragraphs.
+    :param h1: The style of the chapter names.
+    """
+    num_chaps = len(fanfic.chap_links)
+    for chapter in fanfic.iter_chapters():
+        yield from chapter_flowables(chapter, style, h1)
+        if num_chaps != chapter.number:
+            yield PageBreak()
 
-    #TODO: Purge the HTML tags from the text gotten from get_text_r ...
+    yield Spacer(1, 12)
 
 
+def chapter_flowables(chapter: Chapter, style: ParagraphStyle, h1: ParagraphStyle) -> Iterator:
+    """
+    Yield the flowables of one chapter: its name (bookmarked) and its paragraphs.
+    :param chapter: The chapter.
+    :param style: The style of the paragraphs.
+    :param h1: The style of the chapter names.
+    """
+    yield Spacer(1, 12)
+    if chapter.name:
+        yield ChapterHeading(escape(chapter.name), h1, number=chapter.number)
+    yield Spacer(1, 12)
+    yield Spacer(1, 12)
+    for paragraph in chapter.paragraphs:
+        yield make_paragraph(paragraph, style)
+        yield Spacer(1, 12)
+
+
+class ChapterHeading(Paragraph):
+    """
+    A chapter name that bookmarks its page as 'chapter-<number>', the target of the contents links,
+    and adds it to the PDF outline.
+    """
+
+    def __init__(self, text: Optional[str], style: ParagraphStyle, *args, number: Optional[int] = None, **kwargs):
+        """
+        :param text: The chapter name (paragraph markup); None when Paragraph.split() builds a part from frags.
+        :param number: The chapter number; None for the parts after the first of a split heading,
+        which are drawn without a bookmark.
+        """
+        super().__init__(text if text is None else fallback_fonts(text), style, *args, **kwargs)
+        self.number = number
+        # The outline entry; the parts of a split heading have no plain text of their own
+        self.title = self.getPlainText() if text is not None else None
+
+    def split(self, availWidth, availHeight):
+        parts = super().split(availWidth, availHeight)
+        if parts:
+            parts[0].number = self.number
+            parts[0].title = self.title
+        return parts
+
+    def draw(self):
+        if self.number is not None:
+            key = "chapter-{}".format(self.number)
+            self.canv.bookmarkPage(key)
+            self.canv.addOutlineEntry(self.title, key, level=0)
+        super().draw()
+
+
+class ContentsLine(Paragraph):
+    """
+    A line of the contents whose chapter is in another PDF (see render.py): instead of linking,
+    it records (chapter number, page index, rectangle) in 'rects' when drawn.
+    """
+
+    def __init__(self, text: Optional[str], style: ParagraphStyle, *args, number: Optional[int] = None,
+                 rects: Optional[List] = None, **kwargs):
+        """
+        :param text: The chapter name (paragraph markup); None when Paragraph.split() builds a part from frags.
+        :param number: The chapter number.
+        :param rects: The list the line records where it was drawn in.
+        """
+        if text is not None:
+            text = "<font color='blue'>{}</font>".format(fallback_fonts(text))
+        super().__init__(text, style, *args, **kwargs)
+        self.number = number
+        self.rects = rects
+
+    def split(self, availWidth, availHeight):
+        # Every part of a line split across pages links to the chapter
+        parts = super().split(availWidth, availHeight)
+        for part in parts:
+            part.number = self.number
+            part.rects = self.rects
+        return parts
+
+    def draw(self):
+        if self.rects is not None:
+            x, y = self.canv.absolutePosition(0, 0)
+            self.rects.append((self.number, self.canv.getPageNumber() - 1, (x, y, x + self.width, y + self.height)))
+        super().draw()
+
+
+class FlowableStream(list):
+    """
+    The list of flowables handed to doc.build(), filled lazily from an iterator.
+
+    ReportLab consumes the list from the front; this list only ever holds a small window of flowables
+    and tops itself up whenever build() looks at it. Peak memory is then bounded by the chapter being
+    laid out instead of the whole story, and removing the first flowable stays cheap.
+    """
+
+    def __init__(self, flowables: Iterable, window: int = 64):
+        """
+        :param flowables: The flowables of the document, in order.
+        :param window: How many flowables are held at a time (ReportLab looks ahead for keepWithNext).
+        """
+        super().__init__()
+        self.source = iter(flowables)
+        self.window = window
+
+    def fill(self) -> None:
+        if self.source is not None and list.__len__(self) < self.window:
+            wanted = 2 * self.window - list.__len__(self)
+            before = list.__len__(self)
+            self.extend(islice(self.source, wanted))
+            if list.__len__(self) - before < wanted:
+                self.source = None # exhausted
+
+    def __len__(self) -> int:
+        self.fill()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self.fill()
+        return list.__getitem__(self, index)
+
+
+def markup_to_text(paragraph: str) -> str:
+    """
+    Return a paragraph of ReportLab markup as plain text: line breaks kept, all other tags dropped, entities decoded.
+    """
+    return unescape(TAGS.sub('', paragraph.replace('<br/>', '\n')))
+
+
+def write_text(fanfic: Fanfic, path: str) -> None:
+    """
+    Write the fanfic to a plain text file: its title, author and summary, then every chapter
+    under its name, one paragraph per line.
+    :param fanfic: The fanfic.
+    :param path: The text file to create.
+    """
+    with get_recorder().timer('write', story=get_labels(fanfic.url).get('story')), \
+            atomic_path(path) as tmp_path, open(tmp_path, "w", encoding="utf-8") as file_object:
+        file_object.write("{0}\nby {1}\n\n{2}\n\nOriginally posted at: {3}\n".format(
+            fanfic.profile['title'], fanfic.profile['author'], fanfic.profile['summary'], fanfic.chap_links[0]))
+        for chapter in fanfic.iter_chapters():
+            file_object.write("\n\n")
+            if chapter.name:
+                file_object.write(chapter.name + "\n\n")
+            for paragraph in chapter.paragraphs:
+                file_object.write(markup_to_text(paragraph) + "\n")
+
+
+def generate_text_file(url: str, max_workers: int = MAX_WORKERS, extract_processes: int = 0) -> None:
+    """
+    Generate a text file from the given URL.
+    :param url: A link to a fanfiction on a site such as fanfiction.net.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    :param extract_processes: If more than 0, chapters are parsed by this many processes.
+    """
+    fanfic = Fanfic(url, max_workers, extract_processes)
+    write_text(fanfic, get_path(fanfic.title + '.txt'))
+    fanfic.clear_checkpoints()
 
 
 if __name__ == '__main__':
@@ -525,8 +1091,8 @@ if __name__ == '__main__':
 
 
 
-#TODO: never take in mobile version of fanfiction.net, UnicodeEncodeError, PDF chapter links,
-# boxy stats, new <p></p> tag removal method, japanese characters, understand split() better, optimize, brave girl coming home repition of text, extra page at the end Brave girl ..., div with no p tags, div with p tags,
+#TODO: never take in mobile version of fanfiction.net,
+# boxy stats, new <p></p> tag removal method, understand split() better, optimize, brave girl coming home repition of text, extra page at the end Brave girl ..., div with no p tags, div with p tags,
 # tales from the house of the moon - chapter 18, 21 -- for line in story, line is acting like a nested paragraph. So all paragraphs are appended at once. UGHHH
 # ReportLab supports all <i>, <em>, <strong>, <b>, and <u>. All other tags, even nonsensical ones, it does not show. i.e. <p> shows up as nothing. ''
 # <center><strong><em> ... <p> ... </p> I didn't account for nested <p> tags
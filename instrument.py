@@ -0,0 +1,159 @@
+import cProfile
+import csv
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# The fields of a run report record, in CSV column order; other labels and details go last
+RECORD_FIELDS = ['stage', 'story', 'chapter', 'seconds']
+
+
+class Recorder:
+    """
+    Collects timers and counters for the stages of a run (fetch, parse, extract, layout, write),
+    labelled per story and chapter, and writes them out as a machine-readable run report.
+
+    Optionally, every run of one chosen stage is profiled with cProfile and the stats accumulated.
+    The recorder is thread-safe, so download threads can share it.
+    """
+
+    def __init__(self, profile_stage: Optional[str] = None):
+        """
+        :param profile_stage: The stage to run under cProfile, if any (e.g. 'layout').
+        """
+        self.profile_stage = profile_stage
+        self.records = []  # type: List[Dict]
+        self.counters = {}  # type: Dict[str, float]
+        # Stage totals merged from recorders whose records weren't kept (see merge())
+        self.stages = {}  # type: Dict[str, Dict]
+        self.stats = None  # type: Optional[pstats.Stats]
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()  # cProfile can only profile one stage run at a time
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """
+        Time the body of the with statement as one run of 'stage'. Details only known once the stage
+        ran (e.g. the HTTP status) can be added to the yielded record; totals belong in count().
+        """
+        record = {'stage': stage}
+        record.update(labels)
+        profiler = None
+        if stage == self.profile_stage and self.profiling.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.profiling.release()
+            with self.lock:
+                self.records.append(record)
+                if profiler is not None:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profiler)
+                    else:
+                        self.stats.add(profiler)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Add 'value' to the counter 'name'.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, records: List[Dict], counters: Dict[str, float], stages: Optional[Dict[str, Dict]] = None) -> None:
+        """
+        Add the stage records and counters collected by another recorder, e.g. in a worker process.
+        :param stages: The other recorder's stage totals (see summary()), when its records aren't passed on.
+        """
+        with self.lock:
+            self.records.extend(records)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, totals in (stages or {}).items():
+                stage = self.stages.setdefault(name, {'runs': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                stage['runs'] += totals['runs']
+                stage['seconds'] += totals['seconds']
+                stage['max_seconds'] = max(stage['max_seconds'], totals['max_seconds'])
+
+    def summary(self) -> Dict:
+        """
+        Return the totals: for every stage its number of runs and total/max seconds, plus the counters.
+        """
+        with self.lock:
+            stages = {name: dict(totals) for name, totals in self.stages.items()}
+            for record in self.records:
+                stage = stages.setdefault(record['stage'], {'runs': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                stage['runs'] += 1
+                stage['seconds'] += record['seconds']
+                stage['max_seconds'] = max(stage['max_seconds'], record['seconds'])
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def write_json(self, path: str) -> None:
+        """
+        Write the summary and every stage record to a JSON file.
+        """
+        report = self.summary()
+        with self.lock:
+            report['records'] = list(self.records)
+        with open(path, "w", encoding="utf-8") as file_object:
+            json.dump(report, file_object, indent=2)
+
+    def write_csv(self, path: str) -> None:
+        """
+        Write every stage record to a CSV file, one row per stage run.
+        """
+        with self.lock:
+            records = list(self.records)
+        fields = list(RECORD_FIELDS)
+        for record in records:
+            fields.extend(key for key in record if key not in fields)
+        with open(path, "w", encoding="utf-8", newline="") as file_object:
+            writer = csv.DictWriter(file_object, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+
+    def write(self, path: str) -> None:
+        """
+        Write the run report, as CSV if 'path' ends in .csv and as JSON otherwise.
+        """
+        if path.endswith(".csv"):
+            self.write_csv(path)
+        else:
+            self.write_json(path)
+
+    def dump_profile(self, path: str) -> bool:
+        """
+        Save the accumulated cProfile stats of the profiled stage (for pstats or snakeviz).
+        Return False if nothing was profiled.
+        """
+        with self.lock:
+            if self.stats is None:
+                return False
+            self.stats.dump_stats(path)
+            return True
+
+
+_recorder = Recorder()
+
+
+def get_recorder() -> Recorder:
+    """
+    Return the recorder all stages report to.
+    """
+    return _recorder
+
+
+def set_recorder(recorder: Recorder) -> None:
+    """
+    Replace the recorder all stages report to, e.g. to start a fresh report or to profile a stage.
+    """
+    global _recorder
+    _recorder = recorder
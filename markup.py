@@ -0,0 +1,101 @@
+import re
+from typing import Tuple
+from xml.sax.saxutils import escape, quoteattr
+from bs4 import Tag
+from reportlab.lib.colors import toColor
+from bs4.element import PreformattedString
+
+# HTML inline tags and the ReportLab paragraph markup they become.
+# Tags missing from the table (p, span, div, ...) add no markup of their own; their text is kept.
+INLINE_MARKUP = {
+    'b': ('<b>', '</b>'),
+    'strong': ('<b>', '</b>'),
+    'i': ('<i>', '</i>'),
+    'em': ('<i>', '</i>'),
+    'cite': ('<i>', '</i>'),
+    'u': ('<u>', '</u>'),
+    'ins': ('<u>', '</u>'),
+    's': ('<strike>', '</strike>'),
+    'strike': ('<strike>', '</strike>'),
+    'del': ('<strike>', '</strike>'),
+    'sup': ('<super>', '</super>'),
+    'sub': ('<sub>', '</sub>'),
+    'br': ('<br/>', ''),
+}
+# Inline CSS (e.g. <span style="text-decoration: underline;">) and the markup it becomes
+STYLE_MARKUP = [
+    (re.compile(r'text-decoration\s*:[^;]*underline'), '<u>', '</u>'),
+    (re.compile(r'text-decoration\s*:[^;]*line-through'), '<strike>', '</strike>'),
+    (re.compile(r'font-weight\s*:\s*(bold|[6-9]00)'), '<b>', '</b>'),
+    (re.compile(r'font-style\s*:\s*(italic|oblique)'), '<i>', '</i>'),
+]
+
+
+def is_color(value: str) -> bool:
+    """
+    Return True if ReportLab understands 'value' as a colour ('red', '#ff0000', ...). Paragraph raises
+    on any other <font color>, which would abort the whole PDF build.
+    """
+    try:
+        toColor(value)
+    except ValueError:
+        return False
+    return True
+
+
+def tag_markup(tag: Tag) -> Tuple[str, str]:
+    """
+    Return the ReportLab markup that opens and closes the formatting of an HTML tag, e.g. ('<b>', '</b>').
+    Tags without any formatting ReportLab can show return ('', '').
+    """
+    opening, closing = INLINE_MARKUP.get(tag.name, ('', ''))
+    if tag.name == 'a' and tag.get('href'):
+        opening, closing = '<a href={}>'.format(quoteattr(tag['href'])), '</a>'
+    elif tag.name == 'font' and tag.get('color') and is_color(tag['color']):
+        opening, closing = '<font color={}>'.format(quoteattr(tag['color'])), '</font>'
+    style = tag.get('style')
+    if style:
+        style = style.lower()
+        for pattern, style_opening, style_closing in STYLE_MARKUP:
+            if pattern.search(style):
+                opening, closing = opening + style_opening, style_closing + closing
+    return opening, closing
+
+
+def translate(tag: Tag) -> str:
+    """
+    Return the content of an HTML tag as ReportLab paragraph markup, in a single pass over its subtree:
+    formatting tags are mapped through INLINE_MARKUP/STYLE_MARKUP, all other tags are dropped
+    and the text is escaped. Return '' if the tag holds no visible text.
+    """
+    parts = []
+    has_text = False
+    opening, closing = tag_markup(tag)
+    parts.append(opening)
+    # Plain str items on the stack are closing markup; bs4 strings are NavigableString, a subclass
+    stack = [closing]
+    stack.extend(reversed(tag.contents))
+    while stack:
+        node = stack.pop()
+        if type(node) is str:
+            parts.append(node)
+        elif isinstance(node, Tag):
+            opening, closing = tag_markup(node)
+            parts.append(opening)
+            stack.append(closing)
+            stack.extend(reversed(node.contents))
+        elif not isinstance(node, PreformattedString): # comments, CDATA, doctypes, ...
+            text = str(node).replace("\xa0", " ").replace("\n", " ")
+            if text.strip():
+                has_text = True
+            parts.append(escape(text))
+    if not has_text:
+        return ''
+    return ''.join(parts).strip()
+
+
+def translate_string(text: str) -> str:
+    """
+    Return a loose piece of text as ReportLab paragraph markup.
+    """
+    return escape(text.replace("\xa0", " ").replace("\n", " ").strip())
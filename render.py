@@ -0,0 +1,157 @@
+"""
+Render a fanfic's PDF on several cores: the front matter page and every chapter are laid out as separate PDFs
+in a pool of processes, then merged into the final file with page labels, a chapter outline and
+links from the contents to the chapters.
+
+Every part embeds its own font subsets. To keep the merged file close to the size of write_pdf's, the parts
+all start their subsets with the same characters, so that the merge can keep one copy of them.
+
+Needs pypdf (pip install pypdf) for the merge.
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import SimpleDocTemplate, PageBreak
+from generate_fanfiction_file import Chapter, Fanfic, front_matter_flowables, chapter_flowables, register_fonts, \
+    get_labels, style, h1, FONT_FILES
+from instrument import get_recorder
+from cache import atomic_path
+
+try:
+    from pypdf import PdfWriter
+    from pypdf.annotations import Link
+except ImportError:  # pypdf is only needed to render in parallel
+    PdfWriter = None
+
+# The characters every part's first font subset (256 codes) starts with, the most used in fanfics first:
+# typographic quotes and dashes, then Latin-1. The rest of the subset is filled from the face's own characters.
+SHARED_CHARACTERS = '\u2018\u2019\u201c\u201d\u2013\u2014\u2026' + ''.join(map(chr, range(0xa1, 0x100)))
+SUBSET_SIZE = 256
+
+
+def make_doc(path: str) -> SimpleDocTemplate:
+    """
+    Return a document with the same page size and margins as write_pdf.
+    """
+    return SimpleDocTemplate(path, pagesize=letter,
+                             rightMargin=72, leftMargin=72,
+                             topMargin=40, bottomMargin=40)
+
+
+def build_part(path: str, flowables: List) -> None:
+    """
+    Lay out flowables as one part of the PDF. Before anything is drawn, the first subset of every TrueType face
+    is filled with the same characters in the same order, so the subsets embedded by different parts are identical
+    as long as they only use those characters.
+    """
+    pdf_docs = []
+    fonts = [pdfmetrics.getFont(face) for face in FONT_FILES if face in pdfmetrics.getRegisteredFontNames()]
+    fonts = [font for font in fonts if isinstance(font, TTFont)]
+
+    def share_subsets(canvas, doc):
+        pdf_docs.append(canvas._doc)
+        for font in fonts:
+            characters = SHARED_CHARACTERS + ''.join(map(chr, sorted(font.face.charToGlyph)))
+            for character in characters:
+                font.splitString(character, canvas._doc)
+                if font.state[canvas._doc].nextCode >= SUBSET_SIZE:
+                    break
+
+    try:
+        make_doc(path).build(flowables, onFirstPage=share_subsets)
+    finally:
+        # ReportLab only drops the subset state of the faces the part actually used
+        for font in fonts:
+            for pdf_doc in pdf_docs:
+                font.state.pop(pdf_doc, None)
+
+
+def render_chapter(number: int, name: str, paragraphs: List[str], path: str) -> Tuple[int, str]:
+    """
+    Lay out one chapter as its own PDF, in a worker process. Return (chapter number, path).
+    The chapter is passed as plain data so that it pickles cheaply.
+    """
+    register_fonts()
+    build_part(path, list(chapter_flowables(Chapter(number, name, None, paragraphs), style, h1)))
+    return number, path
+
+
+def render_front_matter(fanfic: Fanfic, path: str) -> List:
+    """
+    Lay out the front matter page as its own PDF. Return where its contents lines were drawn:
+    [(chapter number, page index, rectangle)], to link them to the chapters once merged.
+    """
+    register_fonts()
+    toc_rects = []
+    Story = front_matter_flowables(fanfic, toc_rects)
+    Story.append(PageBreak())
+    build_part(path, Story)
+    return toc_rects
+
+
+def merge_parts(front_path: str, toc_rects: List, parts: List[Tuple[Chapter, str]], path: str) -> None:
+    """
+    Concatenate the front matter and chapter PDFs into 'path'. The front matter pages are numbered
+    i, ii, ... and the chapters from 1; every named chapter gets an outline entry and its contents line a link.
+    :param front_path: The front matter PDF.
+    :param toc_rects: Where the front matter's contents lines were drawn (see render_front_matter).
+    :param parts: (chapter, PDF) pairs, in order.
+    :param path: The PDF file to create.
+    """
+    writer = PdfWriter()
+    writer.append(front_path, import_outline=False)
+    front_pages = len(writer.pages)
+    first_pages = {}
+    for chapter, part in parts:
+        first_pages[chapter.number] = len(writer.pages)
+        writer.append(part, import_outline=False)
+        if chapter.name:
+            writer.add_outline_item(chapter.name, first_pages[chapter.number])
+
+    writer.set_page_label(0, front_pages - 1, style='/r')
+    if len(writer.pages) > front_pages:
+        writer.set_page_label(front_pages, len(writer.pages) - 1, style='/D', start=1)
+    for number, page_index, rect in toc_rects:
+        if number in first_pages:
+            writer.add_annotation(page_index, Link(rect=rect, target_page_index=first_pages[number]))
+
+    # Keep one copy of the font subsets the parts share (see build_part). The parts' fonts only differ in
+    # their /Name, which is obsolete (pages refer to fonts by resource name), so it is dropped first.
+    # Each pass only merges objects whose references are already the same: the font files, then
+    # the font descriptors pointing to them, then the fonts.
+    for page in writer.pages:
+        for font in page.get('/Resources', {}).get('/Font', {}).values():
+            font.get_object().pop('/Name', None)
+    for _ in range(3):
+        writer.compress_identical_objects()
+    with atomic_path(path) as tmp_path, open(tmp_path, "wb") as file_object:
+        writer.write(file_object)
+
+
+def write_pdf_parallel(fanfic: Fanfic, path: str, processes: Optional[int] = None) -> None:
+    """
+    Write the fanfic to a PDF file like write_pdf, but lay out the chapters in a pool of processes.
+    Chapters are handed to the pool as soon as they are downloaded, so layout overlaps the download.
+    :param fanfic: The fanfic.
+    :param path: The PDF file to create.
+    :param processes: The number of layout processes; defaults to the number of cores.
+    """
+    if PdfWriter is None:
+        raise ImportError("Rendering a PDF in parallel needs pypdf: pip install pypdf")
+
+    with get_recorder().timer('layout', story=get_labels(fanfic.url).get('story'), processes=processes), \
+            tempfile.TemporaryDirectory(prefix="render-") as tmp, \
+            ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = []
+        for chapter in fanfic.iter_chapters():
+            part = os.path.join(tmp, "chapter-{}.pdf".format(chapter.number))
+            futures.append((chapter, executor.submit(render_chapter, chapter.number, chapter.name,
+                                                     chapter.paragraphs, part)))
+        front_path = os.path.join(tmp, "front.pdf")
+        toc_rects = render_front_matter(fanfic, front_path)
+        parts = [(chapter, future.result()[1]) for chapter, future in futures]
+        merge_parts(front_path, toc_rects, parts, path)
@@ -0,0 +1,109 @@
+import json
+import os
+from typing import Dict, List, Optional
+from cache import ChapterCache, get_cache, set_cache, story_key, write_atomic
+from generate_fanfiction_file import StoryPage, simple_get, map_chapters, MAX_WORKERS
+from checkpoint import VERSION_KEYS
+from writers import generate
+
+# The profile and chapter names seen at the last archive run of each story: fanfiction/.state/<story id>.json
+STATE_DIR = os.path.join("fanfiction", ".state")
+
+
+def get_state_path(story_id: str) -> str:
+    """
+    Return the path to the saved state of a story.
+    """
+    return os.path.join(STATE_DIR, story_id + ".json")
+
+
+def load_state(story_id: str) -> Optional[Dict]:
+    """
+    Return the state saved at the last archive run of a story, or None if it was never archived.
+    """
+    try:
+        with open(get_state_path(story_id), encoding="utf-8") as file_object:
+            return json.load(file_object)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(story_id: str, profile_dict: Dict, lst_chap_names: List) -> None:
+    """
+    Save the profile and chapter names of a story, to compare against at the next update.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    state = {'profile': profile_dict, 'chap_names': lst_chap_names}
+    write_atomic(get_state_path(story_id), json.dumps(state).encode("utf-8"))
+
+
+def get_changed_links(state: Dict, profile_dict: Dict, lst_chap_names: List, lst_chap_links: List) -> List:
+    """
+    Return the links of the chapters that were added or may have changed since 'state' was saved.
+
+    New chapters are always included. Existing chapters are included if they were renamed, or,
+    when the story was updated without gaining chapters (i.e. an edit), all of them are, so that
+    they get revalidated against the cache.
+    :param state: The state saved at the last archive run.
+    :param profile_dict: The current profile of the story.
+    :param lst_chap_names: The current chapter names.
+    :param lst_chap_links: The current chapter links.
+    """
+    old_names = state['chap_names']
+    old_count = int(state['profile']['chapters'])
+    changed = lst_chap_links[old_count:]
+    if len(lst_chap_links) <= old_count and profile_dict['updated_date'] != state['profile']['updated_date']:
+        return lst_chap_links
+    for i in range(min(old_count, len(lst_chap_links))):
+        if i < len(old_names) and i < len(lst_chap_names) and old_names[i] != lst_chap_names[i]:
+            changed.append(lst_chap_links[i])
+    return changed
+
+
+def update_story(url: str, outputs=('pdf',), max_workers: int = MAX_WORKERS, render_processes: int = 0,
+                 extract_processes: int = 0) -> bool:
+    """
+    Re-archive a story, fetching only the chapters that were added or changed since the last run.
+    The outputs are then regenerated from the cached chapters. Return True if the story had changed.
+
+    If nothing changed, this costs a single (conditional) request for the story's page.
+    :param url: A link to a fanfiction on a site such as fanfiction.net.
+    :param outputs: The formats to regenerate, keys of writers.WRITERS.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    :param render_processes: If more than 1, the PDF chapters are laid out by this many processes.
+    :param extract_processes: If more than 0, chapters are parsed by this many processes.
+    """
+    cache = get_cache()
+    if cache is None:
+        raise Exception('Updating {} needs the chapter cache to be enabled'.format(url))
+    story_id = story_key(url)[0]
+    state = load_state(story_id)
+
+    page = StoryPage(url, simple_get(url, revalidate=True))
+    profile_dict = page.get_profile()
+    lst_chap_names = page.get_chap_name()
+    if state is not None and lst_chap_names == state['chap_names'] and \
+            all(profile_dict[key] == state['profile'][key] for key in VERSION_KEYS):
+        return False
+
+    if state is None:
+        # Never archived: build normally, going through the cache with its usual TTL
+        generate(url, outputs, max_workers, render_processes, extract_processes)
+    else:
+        lst_changed = [link for link in get_changed_links(state, profile_dict, lst_chap_names, page.generate_links())
+                       if link != page.url]
+        lst_pages = map_chapters(lambda link: simple_get(link, revalidate=True), lst_changed, max_workers)
+        lst_failed = [link for link, content in zip(lst_changed, lst_pages) if content is None]
+        if lst_failed:
+            # Rendering now would use the stale cached copies, and saving the state would hide that for good
+            raise Exception('Error revalidating {0} changed chapter(s) of {1}: {2}'.format(
+                len(lst_failed), url, ', '.join(lst_failed)))
+        # Everything is cached and current now, so render without revalidating anything
+        set_cache(ChapterCache(cache.root, ttl=None, max_bytes=cache.max_bytes, offline=cache.offline))
+        try:
+            generate(url, outputs, max_workers, render_processes, extract_processes)
+        finally:
+            set_cache(cache)
+
+    save_state(story_id, profile_dict, lst_chap_names)
+    return True
@@ -0,0 +1,184 @@
+import logging
+import re
+import time
+import zipfile
+from typing import Iterable, List
+from xml.sax.saxutils import escape, quoteattr
+from generate_fanfiction_file import Fanfic, write_pdf, write_text, get_path, get_labels, MAX_WORKERS
+from instrument import get_recorder
+from cache import atomic_path
+from catalog import get_catalog
+from dedup import near_duplicate_chapters
+from render import write_pdf_parallel
+
+# ReportLab paragraph markup tags that are spelled differently in HTML; <b>, <i>, <u>, <a>, <sub> and <br/> are shared
+HTML_TAGS = re.compile(r'<(/?)(strike|super|font)\b([^>]*)>')
+HTML_NAMES = {'strike': 's', 'super': 'sup', 'font': 'span'}
+COLOR = re.compile(r'''color=(["'])(.*?)\1''')
+logger = logging.getLogger(__name__)
+
+HTML_PAGE = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">
+<head><meta charset="utf-8"/><title>{title}</title>
+<style>body {{ font-family: Georgia, serif; max-width: 40em; margin: auto; line-height: 1.4; }}
+h1, h2 {{ text-align: center; }} .profile dt {{ font-weight: bold; }}</style></head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def markup_to_html(paragraph: str) -> str:
+    """
+    Return a paragraph of ReportLab markup as XHTML. The markup is already escaped XML,
+    so only the few tags HTML spells differently need renaming.
+    """
+    def rename(match):
+        closing, name, attrs = match.groups()
+        if name == 'font' and not closing:
+            color = COLOR.search(attrs)
+            return '<span style={}>'.format(quoteattr('color: ' + color.group(2))) if color else '<span>'
+        return '<{0}{1}>'.format(closing, HTML_NAMES[name])
+    return HTML_TAGS.sub(rename, paragraph)
+
+
+def profile_html(fanfic: Fanfic) -> str:
+    """
+    Return the front matter of the fanfic as XHTML: title, author, summary, source link and stats.
+    """
+    profile = fanfic.profile
+    stats = [('Rating', 'rating'), ('Fandom', 'fandom'), ('Genre', 'genre'), ('Characters', 'characters'),
+             ('Words', 'words'), ('Chapters', 'chapters'), ('Published on', 'publication_date'),
+             ('Updated on', 'updated_date'), ('Status', 'status')]
+    items = ''.join('<dt>{0}</dt><dd>{1}</dd>'.format(label, escape(profile[key]))
+                    for label, key in stats if profile.get(key))
+    return ('<h1>{title}</h1>\n<h2>by <a href={author_link}>{author}</a></h2>\n'
+            '<h3>Summary</h3>\n<p>{summary}</p>\n<hr/>\n'
+            '<p>Originally posted at: <a href={link}>{link_text}</a>.</p>\n'
+            '<dl class="profile">{items}</dl>').format(
+        title=escape(profile['title']), author_link=quoteattr(profile['author_link']),
+        author=escape(profile['author']), summary=escape(profile['summary']),
+        link=quoteattr(fanfic.chap_links[0]), link_text=escape(fanfic.chap_links[0]), items=items)
+
+
+def chapter_html(chapter) -> str:
+    """
+    Return a chapter as XHTML: its name as a heading, then its paragraphs.
+    """
+    parts = ['<section id="chapter-{}">'.format(chapter.number)]
+    if chapter.name:
+        parts.append('<h2>{}</h2>'.format(escape(chapter.name)))
+    parts.extend('<p>{}</p>'.format(markup_to_html(paragraph)) for paragraph in chapter.paragraphs)
+    parts.append('</section>')
+    return '\n'.join(parts)
+
+
+def write_html(fanfic: Fanfic, path: str) -> None:
+    """
+    Write the fanfic to a single self-contained HTML file, with a linked table of contents.
+    The chapters are written one at a time, as they are read.
+    :param fanfic: The fanfic.
+    :param path: The HTML file to create.
+    """
+    with get_recorder().timer('write', story=get_labels(fanfic.url).get('story'), format='html'), \
+            atomic_path(path) as tmp_path, open(tmp_path, "w", encoding="utf-8") as file_object:
+        head, tail = HTML_PAGE.split('{body}')
+        file_object.write(head.format(title=escape(fanfic.profile['title'])))
+        file_object.write(profile_html(fanfic))
+        if len(fanfic.chap_names) > 1:
+            file_object.write('\n<nav><ol>{}</ol></nav>'.format(''.join(
+                '<li><a href="#chapter-{0}">{1}</a></li>'.format(number, escape(name))
+                for number, name in enumerate(fanfic.chap_names, 1))))
+        for chapter in fanfic.iter_chapters():
+            file_object.write('\n' + chapter_html(chapter))
+        file_object.write(tail)
+
+
+def write_epub(fanfic: Fanfic, path: str) -> None:
+    """
+    Write the fanfic to an EPUB 3 file: a title page with its profile, then one XHTML file per chapter.
+    Each chapter is added to the archive as soon as it is read; the package files that list them come last.
+    :param fanfic: The fanfic.
+    :param path: The EPUB file to create.
+    """
+    with get_recorder().timer('write', story=get_labels(fanfic.url).get('story'), format='epub'), \
+            atomic_path(path) as tmp_path, zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as epub:
+        profile = fanfic.profile
+        title = escape(profile['title'])
+        # The mimetype must come first, uncompressed
+        epub.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        files = [('title.xhtml', 'Title page')]
+        epub.writestr("OEBPS/title.xhtml", HTML_PAGE.format(title=title, body=profile_html(fanfic)))
+        for chapter in fanfic.iter_chapters():
+            name = chapter.name or profile['title']
+            filename = 'chapter-{}.xhtml'.format(chapter.number)
+            files.append((filename, name))
+            epub.writestr("OEBPS/" + filename, HTML_PAGE.format(title=escape(name), body=chapter_html(chapter)))
+
+        nav = '<nav epub:type="toc" id="toc"><h1>Contents</h1><ol>{}</ol></nav>'.format(''.join(
+            '<li><a href="{0}">{1}</a></li>'.format(filename, escape(name)) for filename, name in files))
+        manifest = ''.join('<item id="f{0}" href="{1}" media-type="application/xhtml+xml"/>'.format(i, filename)
+                           for i, (filename, _) in enumerate(files))
+        spine = ''.join('<itemref idref="f{}"/>'.format(i) for i in range(len(files)))
+        opf = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+               '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+               '<dc:identifier id="id">{identifier}</dc:identifier><dc:title>{title}</dc:title>'
+               '<dc:creator>{author}</dc:creator><dc:language>en</dc:language>'
+               '<dc:description>{summary}</dc:description>'
+               '<meta property="dcterms:modified">{modified}</meta></metadata>'
+               '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+               '{manifest}</manifest><spine>{spine}</spine></package>').format(
+            identifier=escape(fanfic.chap_links[0]), title=title, author=escape(profile['author']),
+            summary=escape(profile['summary']), manifest=manifest, spine=spine,
+            modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        container = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                     '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                     '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                     '</rootfiles></container>')
+        epub.writestr("META-INF/container.xml", container)
+        epub.writestr("OEBPS/content.opf", opf)
+        epub.writestr("OEBPS/nav.xhtml", HTML_PAGE.format(title=title, body=nav))
+
+
+# Output format -> (writer, file extension)
+WRITERS = {'pdf': (write_pdf, '.pdf'),
+           'txt': (write_text, '.txt'),
+           'epub': (write_epub, '.epub'),
+           'html': (write_html, '.html')}
+
+
+def generate(url: str, formats: Iterable[str] = ('pdf',), max_workers: int = MAX_WORKERS,
+             render_processes: int = 0, extract_processes: int = 0) -> List[str]:
+    """
+    Scrape the fanfic at 'url' once and write it in every requested format, then record it in the catalog.
+    Chapters that are near duplicates of an earlier one are logged and counted. Return the paths written.
+    If writing fails, the chapters extracted so far are kept as checkpoints for the next run (see Fanfic).
+    :param url: A link to a fanfiction on a site such as fanfiction.net.
+    :param formats: Output formats, keys of WRITERS.
+    :param max_workers: The maximum number of chapters downloaded at the same time.
+    :param render_processes: If more than 1, the PDF chapters are laid out by this many processes (see render.py).
+    :param extract_processes: If more than 0, chapters are parsed by this many processes while they are written
+    (see generate_fanfiction_file.pipeline_chapters()).
+    """
+    fanfic = Fanfic(url, max_workers, extract_processes)
+    paths = []
+    for output in formats:
+        writer, extension = WRITERS[output]
+        path = get_path(fanfic.title + extension)
+        if output == 'pdf' and render_processes > 1:
+            write_pdf_parallel(fanfic, path, render_processes)
+        else:
+            writer(fanfic, path)
+        paths.append(path)
+    duplicates = near_duplicate_chapters(fanfic.chapters)
+    for first, second, similarity in duplicates:
+        logger.warning("{0}: chapter {1} is {2:.0%} the same as chapter {3}".format(url, second, similarity, first))
+    get_recorder().count('near_duplicate_chapters', len(duplicates))
+    catalog = get_catalog()
+    if catalog is not None:
+        catalog.add_story(fanfic, paths)
+    fanfic.clear_checkpoints()
+    return paths